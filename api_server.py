@@ -1,23 +1,36 @@
 import os
 import sys
-import psutil
+import time
+import json
+import gzip
+import zlib
+import hashlib
+import base64
 import subprocess
-from datetime import timedelta
+import uuid
+from datetime import timedelta, datetime, timezone
 from dotenv import load_dotenv
 from flask_cors import CORS
-from flask import Flask, jsonify, send_file, request
-from flask_pymongo import PyMongo
+from flask import Flask, jsonify, send_file, request, Response, stream_with_context, g
 from flask_jwt_extended import JWTManager, create_access_token, verify_jwt_in_request
 from flask_swagger_ui import get_swaggerui_blueprint
-from threading import Thread
+from threading import Thread, Lock
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from pymongo.errors import DuplicateKeyError
 from dotenv import load_dotenv
 from urllib.parse import urljoin
-from utils import log_info, steam_is_friend, steam_send_invite, steam_purchase
+from utils import (
+    log_info, steam_is_friend, steam_send_invite, steam_purchase, SteamStepError, PRICE_HISTORY_COLLECTION,
+    HEAVY_FIELDS, split_game_document, details_collection_name, GENERATIONS_COLLECTION,
+    bump_generation, STATS_COLLECTION, LOG_PATH, get_mongo_db
+)
 
-from scraper_nintendo import fetch_nintendo_game_by_title
-from scraper_playstation import fetch_playstation_game_by_title
-from scraper_steam import fetch_steam_game_by_title
-from scraper_xbox import fetch_xbox_game_by_title
+from search_index import TitleIndex
+from linker import LINKS_COLLECTION
+from scheduler import scheduler_locked, scheduler_request, STOP_GRACE_PERIOD
+from priority import record_game_request
+from metrics import observe, inc_counter, flush_metrics, render_metrics, METRICS_COLLECTION
 
 # Flask app initialization
 app = Flask(__name__)
@@ -36,8 +49,71 @@ username = os.getenv("admin", "admin")
 password = os.getenv("password", "password123")
 static_token = os.getenv("STATIC_ACCESS_TOKEN", "land33")
 
-# Initialize PyMongo and JWT
-mongo = PyMongo(app)
+class ProcessMongo:
+    """mongo.db backed by the process-wide client from utils.
+
+    The API shares one pool with its refresh jobs and metric flushes, sized
+    from MONGO_CONNECTION_BUDGET like every other process. The database is
+    looked up on each access so a forked worker never uses its parent's
+    sockets.
+    """
+
+    @property
+    def db(self):
+        return get_mongo_db()
+
+mongo = ProcessMongo()
+
+# Fields returned by list endpoints; heavy fields are served by /game/details
+LIST_PROJECTION = {"_id": 0, "content_hash": 0, **{field: 0 for field in HEAVY_FIELDS}}
+
+SERVICES = ["steam", "xbox", "playstation", "nintendo"]
+
+# Response cache for list endpoints. Entries are tagged with the snapshot
+# generations they were built from and dropped once a generation moves on.
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", "1024"))
+GENERATION_CHECK_INTERVAL = float(os.getenv("GENERATION_CHECK_INTERVAL", "1.0"))
+
+_response_cache = OrderedDict()
+_response_cache_lock = Lock()
+_generations = {}
+_generations_checked_at = 0.0
+
+GZIP_MIN_SIZE = int(os.getenv("GZIP_MIN_SIZE", "1024"))
+
+# /logs limits: lines per tail, bytes scanned per tail and bytes per offset read
+LOG_TAIL_LIMIT = int(os.getenv("LOG_TAIL_LIMIT", "10000"))
+LOG_SCAN_LIMIT = int(os.getenv("LOG_SCAN_LIMIT", str(64 * 1024 * 1024)))
+LOG_READ_LIMIT = int(os.getenv("LOG_READ_LIMIT", str(1024 * 1024)))
+NO_STORE = {"Cache-Control": "no-store"}
+
+# On-demand /game refreshes run as jobs on a bounded pool of threads per worker
+REFRESH_JOBS_COLLECTION = "refresh_jobs"
+REFRESH_WORKERS = int(os.getenv("REFRESH_WORKERS", "2"))
+REFRESH_QUEUE_LIMIT = int(os.getenv("REFRESH_QUEUE_LIMIT", "50"))
+REFRESH_JOB_TIMEOUT = int(os.getenv("REFRESH_JOB_TIMEOUT", "900"))
+REFRESH_JOB_RETENTION = int(os.getenv("REFRESH_JOB_RETENTION", "86400"))
+
+_refresh_executor = ThreadPoolExecutor(max_workers=REFRESH_WORKERS)
+_refresh_lock = Lock()
+_refresh_pending = 0
+_refresh_indexes_ready = False
+
+# Stored games younger than the service TTL are served without scraping
+FRESHNESS_TTL = {
+    svc: int(os.getenv(f"{svc.upper()}_FRESHNESS_TTL", os.getenv("FRESHNESS_TTL", "43200")))
+    for svc in SERVICES
+}
+# A miss holds its worker while it waits for the live scrape, so the wait is
+# capped at a few seconds; slower scrapes answer 202 with the job URL
+GAME_WAIT_MAX = 10
+GAME_WAIT_TIMEOUT = min(float(os.getenv("GAME_WAIT_TIMEOUT", "3")), GAME_WAIT_MAX)
+
+# Title search index, rebuilt in the background when a snapshot changes
+_search_index = None
+_search_index_tag = None
+_search_index_lock = Lock()
+_search_index_building = False
 
 # Custom token verification without Bearer prefix
 def custom_token_verification():
@@ -139,7 +215,36 @@ swagger_config = {
                     {
                         "name": "region",
                         "in": "query",
-                        "type": "string"
+                        "type": "string",
+                        "description": "Only games with a price or free in this region"
+                    },
+                    {
+                        "name": "min_price",
+                        "in": "query",
+                        "type": "number",
+                        "description": "Minimum price in the region currency (requires region)"
+                    },
+                    {
+                        "name": "max_price",
+                        "in": "query",
+                        "type": "number",
+                        "description": "Maximum price in the region currency (requires region)"
+                    },
+                    {
+                        "name": "cursor",
+                        "in": "query",
+                        "type": "string",
+                        "description": "Opaque cursor from next_cursor. Pass an empty cursor to start keyset pagination; page is ignored when set."
+                    },
+                    {
+                        "name": "sort",
+                        "in": "query",
+                        "type": "string",
+                        "enum": [
+                            "price",
+                            "-price"
+                        ],
+                        "description": "Sort by the region price, cheapest first or most expensive first (requires region)"
                     }
                 ],
                 "security": [
@@ -169,6 +274,101 @@ swagger_config = {
                 }
             }
         },
+        "/games/search": {
+            "get": {
+                "summary": "Search Games",
+                "description": "Fuzzy, typo-tolerant and prefix title search over the stored games of all stores.",
+                "parameters": [
+                    {
+                        "name": "q",
+                        "in": "query",
+                        "type": "string",
+                        "required": True
+                    },
+                    {
+                        "name": "service",
+                        "in": "query",
+                        "type": "string",
+                        "enum": [
+                            "steam",
+                            "xbox",
+                            "playstation",
+                            "nintendo"
+                        ]
+                    },
+                    {
+                        "name": "limit",
+                        "in": "query",
+                        "type": "integer",
+                        "default": 10
+                    }
+                ],
+                "security": [
+                    {
+                        "TokenAuth": []
+                    }
+                ],
+                "responses": {
+                    "200": {
+                        "description": "Best matching games with their service and native id."
+                    },
+                    "400": {
+                        "description": "Missing query, invalid service or invalid limit."
+                    }
+                }
+            }
+        },
+        "/games/export": {
+            "get": {
+                "summary": "Export Games",
+                "description": "Stream a service's games as NDJSON, gzip-compressed when the client accepts it.",
+                "parameters": [
+                    {
+                        "name": "service",
+                        "in": "query",
+                        "type": "string",
+                        "enum": [
+                            "steam",
+                            "xbox",
+                            "playstation",
+                            "nintendo"
+                        ],
+                        "required": True
+                    },
+                    {
+                        "name": "fields",
+                        "in": "query",
+                        "type": "string",
+                        "description": "Comma separated fields to include, e.g. title,native_id,prices"
+                    },
+                    {
+                        "name": "updated_since",
+                        "in": "query",
+                        "type": "string",
+                        "description": "Only games whose content changed at or after this ISO 8601 datetime"
+                    },
+                    {
+                        "name": "details",
+                        "in": "query",
+                        "type": "boolean",
+                        "description": "Include full_description and screenshots"
+                    }
+                ],
+                "security": [
+                    {
+                        "TokenAuth": []
+                    }
+                ],
+                "responses": {
+                    "200": {
+                        "description": "NDJSON stream, one game per line."
+                    },
+                    "400": {
+                        "description": "Invalid service or parameters."
+                    }
+                }
+            }
+        },
         "/scheduler/start": {
             "post": {
                 "summary": "Start Scheduler",
@@ -191,7 +391,23 @@ swagger_config = {
         "/scheduler/stop": {
             "post": {
                 "summary": "Stop Scheduler",
-                "description": "Stop the game scraper scheduler process.",
+                "description": "Stop the game scraper scheduler process. Running scrapers are terminated unless after_current is set, in which case the scheduler exits once they finish.",
+                "parameters": [
+                    {
+                        "name": "body",
+                        "in": "body",
+                        "required": False,
+                        "schema": {
+                            "type": "object",
+                            "properties": {
+                                "after_current": {
+                                    "type": "boolean",
+                                    "example": False
+                                }
+                            }
+                        }
+                    }
+                ],
                 "security": [
                     {
                         "TokenAuth": []
@@ -201,6 +417,9 @@ swagger_config = {
                     "200": {
                         "description": "Scheduler stopped successfully."
                     },
+                    "202": {
+                        "description": "Stop requested; the scheduler is still shutting down."
+                    },
                     "404": {
                         "description": "Scheduler not running."
                     },
@@ -213,7 +432,7 @@ swagger_config = {
         "/scheduler/status": {
             "post": {
                 "summary": "Scheduler Status",
-                "description": "Check if the game scraper scheduler process is running.",
+                "description": "Check if the game scraper scheduler process is running, with each scraper's status (running, queued with the reason it is held back, or waiting for its next run), budget, memory use, remaining queue depth and last run.",
                 "security": [
                     {
                         "TokenAuth": []
@@ -229,10 +448,253 @@ swagger_config = {
                 }
             }
         },
-        "/games/count": {
+        "/games/count": {
+            "get": {
+                "summary": "Get Game Count",
+                "description": "Retrieve the count of games for a specific service, optionally only those with a price in a region.",
+                "parameters": [
+                    {
+                        "name": "service",
+                        "in": "query",
+                        "type": "string",
+                        "enum": [
+                            "steam",
+                            "xbox",
+                            "playstation",
+                            "nintendo"
+                        ],
+                        "required": True
+                    },
+                    {
+                        "name": "region",
+                        "in": "query",
+                        "type": "string"
+                    }
+                ],
+                "security": [
+                    {
+                        "TokenAuth": []
+                    }
+                ],
+                "responses": {
+                    "200": {
+                        "description": "Game count retrieved successfully."
+                    },
+                    "400": {
+                        "description": "Invalid service."
+                    }
+                }
+            }
+        },
+        "/game": {
+            "get": {
+                "summary": "Update Game by Title",
+                "description": "Return a game by title. Fresh stored copies are served directly; stale ones are served while a background refresh runs; missing games are scraped live, waiting a few seconds before answering 202 with the job. Concurrent refreshes of the same game share one job.",
+                "parameters": [
+                    {
+                        "name": "title",
+                        "in": "query",
+                        "type": "string",
+                        "required": True
+                    },
+                    {
+                        "name": "service",
+                        "in": "query",
+                        "type": "string",
+                        "enum": [
+                            "steam",
+                            "xbox",
+                            "playstation",
+                            "nintendo"
+                        ],
+                        "required": True
+                    },
+                    {
+                        "name": "region",
+                        "in": "query",
+                        "type": "string",
+                        "required": True
+                    },
+                    {
+                        "name": "refresh",
+                        "in": "query",
+                        "type": "boolean",
+                        "description": "Always queue a live refresh and return its job"
+                    }
+                ],
+                "security": [
+                    {
+                        "TokenAuth": []
+                    }
+                ],
+                "responses": {
+                    "200": {
+                        "description": "Game details; freshness is fresh, stale (refresh_job_id set) or live.",
+                        "schema": {
+                            "type": "object",
+                            "properties": {
+                                "url": { "type": "string", "description": "Direct link to the game" },
+                                "freshness": { "type": "string" }
+                                },
+                            "additionalProperties": True
+                        },
+                    },
+                    "202": {
+                        "description": "Refresh job queued or still running.",
+                        "schema": {
+                            "type": "object",
+                            "properties": {
+                                "job_id": { "type": "string" },
+                                "status": { "type": "string" },
+                                "status_url": { "type": "string" },
+                                "attached": { "type": "boolean", "description": "True when joining an in-flight job" }
+                            }
+                        }
+                    },
+                    "304": {
+                        "description": "The stored copy is still fresh and matches the client's ETag or Last-Modified."
+                    },
+                    "400": {
+                        "description": "Invalid service."
+                    },
+                    "404": {
+                        "description": "Game not found."
+                    },
+                    "503": {
+                        "description": "Refresh queue is full."
+                    }
+                }
+            }
+        },
+        "/game/jobs/{job_id}": {
+            "get": {
+                "summary": "Refresh Job Status",
+                "description": "Status of a refresh job; includes the game once the job is done.",
+                "parameters": [
+                    {
+                        "name": "job_id",
+                        "in": "path",
+                        "type": "string",
+                        "required": True
+                    }
+                ],
+                "security": [
+                    {
+                        "TokenAuth": []
+                    }
+                ],
+                "responses": {
+                    "200": {
+                        "description": "Job status (queued, running, done, not_found or failed)."
+                    },
+                    "404": {
+                        "description": "Job not found."
+                    }
+                }
+            }
+        },
+        "/game/details": {
+            "get": {
+                "summary": "Game Details",
+                "description": "Retrieve a stored game including heavy fields (full description, screenshots).",
+                "parameters": [
+                    {
+                        "name": "service",
+                        "in": "query",
+                        "type": "string",
+                        "enum": [
+                            "steam",
+                            "xbox",
+                            "playstation",
+                            "nintendo"
+                        ],
+                        "required": True
+                    },
+                    {
+                        "name": "title",
+                        "in": "query",
+                        "type": "string"
+                    },
+                    {
+                        "name": "native_id",
+                        "in": "query",
+                        "type": "string",
+                        "description": "Store id of the game. Either title or native_id is required."
+                    }
+                ],
+                "security": [
+                    {
+                        "TokenAuth": []
+                    }
+                ],
+                "responses": {
+                    "200": {
+                        "description": "Game details retrieved successfully."
+                    },
+                    "400": {
+                        "description": "Invalid service or parameters."
+                    },
+                    "404": {
+                        "description": "Game not found."
+                    }
+                }
+            }
+        },
+        "/games/compare": {
+            "get": {
+                "summary": "Compare Prices Across Stores",
+                "description": "All store and region prices of one game, linked across Steam, Xbox, PlayStation and Nintendo.",
+                "parameters": [
+                    {
+                        "name": "id",
+                        "in": "query",
+                        "type": "string",
+                        "description": "Canonical game id"
+                    },
+                    {
+                        "name": "service",
+                        "in": "query",
+                        "type": "string",
+                        "enum": [
+                            "steam",
+                            "xbox",
+                            "playstation",
+                            "nintendo"
+                        ]
+                    },
+                    {
+                        "name": "title",
+                        "in": "query",
+                        "type": "string"
+                    },
+                    {
+                        "name": "native_id",
+                        "in": "query",
+                        "type": "string"
+                    }
+                ],
+                "security": [
+                    {
+                        "TokenAuth": []
+                    }
+                ],
+                "responses": {
+                    "200": {
+                        "description": "Linked stores with their prices per region."
+                    },
+                    "400": {
+                        "description": "Missing parameters."
+                    },
+                    "404": {
+                        "description": "Game not found."
+                    }
+                }
+            }
+        },
+        "/game/prices/history": {
             "get": {
-                "summary": "Get Game Count",
-                "description": "Retrieve the count of games for a specific service.",
+                "summary": "Price History",
+                "description": "Retrieve the latest recorded price changes of a game, oldest first.",
                 "parameters": [
                     {
                         "name": "service",
@@ -245,6 +707,35 @@ swagger_config = {
                             "nintendo"
                         ],
                         "required": True
+                    },
+                    {
+                        "name": "native_id",
+                        "in": "query",
+                        "type": "string",
+                        "description": "Store id of the game. Either native_id or title is required."
+                    },
+                    {
+                        "name": "title",
+                        "in": "query",
+                        "type": "string"
+                    },
+                    {
+                        "name": "region",
+                        "in": "query",
+                        "type": "string"
+                    },
+                    {
+                        "name": "since",
+                        "in": "query",
+                        "type": "string",
+                        "description": "ISO 8601 date or datetime"
+                    },
+                    {
+                        "name": "limit",
+                        "in": "query",
+                        "type": "integer",
+                        "default": 1000,
+                        "description": "Number of most recent changes to return, at most 10000"
                     }
                 ],
                 "security": [
@@ -254,42 +745,55 @@ swagger_config = {
                 ],
                 "responses": {
                     "200": {
-                        "description": "Game count retrieved successfully."
+                        "description": "Price history retrieved successfully."
                     },
                     "400": {
-                        "description": "Invalid service."
+                        "description": "Invalid service or parameters."
+                    },
+                    "404": {
+                        "description": "Game not found."
                     }
                 }
             }
         },
-        "/game": {
+        "/logs": {
             "get": {
-                "summary": "Update Game by Title",
-                "description": "Update game details by title.",
+                "summary": "Fetch Logs",
+                "description": "Retrieve the scraper logs file. Without parameters the whole file is returned; tail, since_offset, level and q return only matching lines. X-Log-Offset holds the offset to resume from and X-Log-Id identifies the file it belongs to.",
                 "parameters": [
                     {
-                        "name": "title",
+                        "name": "tail",
+                        "in": "query",
+                        "type": "integer",
+                        "description": "Number of last (matching) lines to return"
+                    },
+                    {
+                        "name": "since_offset",
+                        "in": "query",
+                        "type": "integer",
+                        "description": "Byte offset to resume from, as returned in X-Log-Offset"
+                    },
+                    {
+                        "name": "log_id",
                         "in": "query",
                         "type": "string",
-                        "required": True
+                        "description": "X-Log-Id returned with since_offset; reading restarts from 0 when the file was rotated since"
                     },
                     {
-                        "name": "service",
+                        "name": "level",
                         "in": "query",
                         "type": "string",
                         "enum": [
-                            "steam",
-                            "xbox",
-                            "playstation",
-                            "nintendo"
-                        ],
-                        "required": True
+                            "INFO",
+                            "WARNING",
+                            "ERROR"
+                        ]
                     },
                     {
-                        "name": "region",
+                        "name": "q",
                         "in": "query",
                         "type": "string",
-                        "required": True
+                        "description": "Only lines containing this text"
                     }
                 ],
                 "security": [
@@ -299,28 +803,18 @@ swagger_config = {
                 ],
                 "responses": {
                     "200": {
-                        "description": "Game details retrieved successfully.",
-                        "schema": {
-                            "type": "object",
-                            "properties": {
-                                "url": { "type": "string", "description": "Direct link to the game" }
-                                },
-                            "additionalProperties": True
-                        },
-                    },
-                    "400": {
-                        "description": "Invalid service."
+                        "description": "Logs retrieved successfully."
                     },
-                    "404": {
-                        "description": "Game not found."
+                    "500": {
+                        "description": "Error occurred while fetching logs."
                     }
                 }
             }
         },
-        "/logs": {
+        "/metrics": {
             "get": {
-                "summary": "Fetch Logs",
-                "description": "Retrieve the scraper logs file.",
+                "summary": "Metrics",
+                "description": "Prometheus text format metrics: per-route request counts and latency, Mongo command time, and scraper counters aggregated across all processes (games saved, upstream requests and errors by host, proxy failures, queue depths).",
                 "security": [
                     {
                         "TokenAuth": []
@@ -328,10 +822,10 @@ swagger_config = {
                 ],
                 "responses": {
                     "200": {
-                        "description": "Logs retrieved successfully."
+                        "description": "Metrics in the Prometheus exposition format."
                     },
                     "500": {
-                        "description": "Error occurred while fetching logs."
+                        "description": "Error occurred while collecting metrics."
                     }
                 }
             }
@@ -437,7 +931,7 @@ swagger_config = {
                 ],
                 "responses": {
                     "200": {
-                        "description": "Purchase initiated successfully."
+                        "description": "Purchase initiated successfully, with the duration of each step in timings_ms. Failed purchases report failed_step."
                     },
                     "400": {
                         "description": "Missing game title or friend username."
@@ -465,16 +959,9 @@ swaggerui_blueprint = get_swaggerui_blueprint(
 
 app.register_blueprint(swaggerui_blueprint, url_prefix=SWAGGER_URL)
 
-# Check if scheduler.py is running
+# The scheduler holds a pidfile lock and answers status/stop on a local control socket
 def is_scheduler_running():
-    for proc in psutil.process_iter(attrs=['cmdline']):
-        try:
-            cmd = proc.info.get('cmdline') or []
-            if any("scheduler.py" in part for part in cmd):
-                return True
-        except (psutil.NoSuchProcess, KeyError):
-            continue
-    return False
+    return scheduler_locked()
 
 # Routes
 @app.route('/scheduler/status', methods=['POST'])
@@ -482,10 +969,11 @@ def check_scheduler_status():
     auth_result = custom_token_verification()
     if isinstance(auth_result, tuple):
         return auth_result
-    if is_scheduler_running():
-        return jsonify({"running": True}), 200
-    else:
-        return jsonify({"running": False}), 200
+    status = scheduler_request({"cmd": "status"})
+    if status is not None:
+        return jsonify(status), 200
+    # Locked but not answering: starting up or busy
+    return jsonify({"running": is_scheduler_running()}), 200
 
 @app.route('/scheduler/start', methods=['POST'])
 def start_scheduler():
@@ -510,42 +998,22 @@ def stop_scheduler():
         return auth_result
     if not is_scheduler_running():
         return jsonify({"msg": "Scheduler not running."}), 404
+    after_current = bool((request.get_json(silent=True) or {}).get("after_current"))
     try:
-        scheduler_stopped = False
-        for proc in psutil.process_iter(attrs=['pid', 'cmdline']):
-            try:
-                cmdline = proc.info.get('cmdline') or []
-                if any("scheduler.py" in part for part in cmdline):
-                    # Kill the scheduler process
-                    proc.terminate()
-                    proc.wait(timeout=5)
-                    scheduler_stopped = True
-                    log_info("******************** Killed Scheduler ********************")
-                    # Terminate child processes
-                    try:
-                        children = proc.children(recursive=True)
-                        for child in children:
-                            try:
-                                child.terminate()
-                                child.wait(timeout=5)
-                            except psutil.NoSuchProcess:
-                                pass
-                            except Exception as e:
-                                print(f"API_server/Stop scheduler : Error terminating child process {child.pid}: {e}")
-                    except psutil.NoSuchProcess:
-                        pass
-                    except Exception as e:
-                        print(f"API_server/Stop scheduler : Error retrieving child processes: {e}")
-                    break
-            except psutil.NoSuchProcess:
-                pass
-            except Exception as e:
-                print(f"API_server/Stop scheduler : Error processing scheduler process {proc.pid}: {e}")
-
-        if scheduler_stopped:
-            return jsonify({"msg": "Scheduler and its subprocesses stopped"}), 200
-        else:
-            return jsonify({"msg": "Scheduler not running"}), 404
+        result = scheduler_request({"cmd": "stop", "after_current": after_current})
+        if result is None:
+            return jsonify({"msg": "Scheduler is not responding on its control socket"}), 500
+        log_info("******************** Stopping Scheduler ********************")
+        if after_current:
+            active = [name for name, info in result.get("scrapers", {}).items() if info.get("status") == "running"]
+            return jsonify({"msg": "Scheduler will stop after the running scrapers finish", "running": active}), 200
+
+        deadline = time.monotonic() + STOP_GRACE_PERIOD + 5
+        while is_scheduler_running() and time.monotonic() < deadline:
+            time.sleep(0.2)
+        if is_scheduler_running():
+            return jsonify({"msg": "Scheduler is stopping"}), 202
+        return jsonify({"msg": "Scheduler and its subprocesses stopped"}), 200
     except Exception as e:
         return jsonify({"msg": f"Error stopping scheduler: {str(e)}"}), 500
 
@@ -555,31 +1023,93 @@ def get_game_count():
     if isinstance(auth_result, tuple):
         return auth_result
     service = request.args.get('service')
+    if service not in SERVICES:
+        return jsonify({"msg": "Invalid service"}), 400
+    return conditional_response([service], lambda: build_count_response(service))
 
-    if service == "steam":
-        collection = mongo.db.steam_games
-    elif service == "xbox":
-        collection = mongo.db.xbox_games
-    elif service == "playstation":
-        collection = mongo.db.playstation_games
-    elif service == "nintendo":
-        collection = mongo.db.nintendo_games
+def build_count_response(service):
+    region = request.args.get('region')
+    collection = mongo.db[f"{service}_games"]
+
+    # Counts computed when the current snapshot was swapped in
+    stats = mongo.db[STATS_COLLECTION].find_one({"_id": service})
+    if stats:
+        if region:
+            count = stats.get("regions", {}).get(region, 0)
+        else:
+            count = stats.get("count", 0)
+        return jsonify({
+            "count": count,
+            "source": "stats",
+            "computed_at": stats["computed_at"].isoformat()
+        }), 200
+
+    # No snapshot stats yet: fall back to cheap estimates
+    if region:
+        count = collection.count_documents({f"price_values.{region}.amount_minor": {"$gte": 0}})
     else:
-        return jsonify({"msg": "Invalid service"}), 400
-    
-    count = collection.count_documents({})
-    return jsonify({"count": count}), 200
+        count = collection.estimated_document_count()
+    return jsonify({"count": count, "source": "estimate"}), 200
+
+@app.route('/metrics', methods=['GET'])
+def fetch_metrics():
+    auth_result = custom_token_verification()
+    if isinstance(auth_result, tuple):
+        return auth_result
+    try:
+        flush_metrics(mongo.db)
+        docs = list(mongo.db[METRICS_COLLECTION].find({}, {"_id": 0}))
+        jobs = mongo.db[REFRESH_JOBS_COLLECTION]
+        gauges = [
+            ("refresh_jobs", jobs.count_documents({"status": status}), {"status": status})
+            for status in ("queued", "running")
+        ]
+        gauges.append(("api_response_cache_entries", len(_response_cache), {}))
+        return Response(render_metrics(docs, gauges), mimetype="text/plain; version=0.0.4", headers=NO_STORE)
+    except Exception as e:
+        return jsonify({"msg": "Error collecting metrics", "error": str(e)}), 500
 
 @app.route('/logs', methods=['GET'])
 def fetch_logs():
     auth_result = custom_token_verification()
     if isinstance(auth_result, tuple):
         return auth_result
+    tail = request.args.get('tail', type=int)
+    since_offset = request.args.get('since_offset', type=int)
+    log_id = request.args.get('log_id')
+    level = request.args.get('level')
+    contains = request.args.get('q')
     try:
-        log_path = os.path.join(BASE_DIR, "scraper.log")
-        if not os.path.exists(log_path):
+        if not os.path.exists(LOG_PATH):
             return jsonify({"msg": "Log file not found"}), 404
-        return send_file(log_path, mimetype="text/plain")
+        if tail is None and since_offset is None and not level and not contains:
+            return send_file(LOG_PATH, mimetype="text/plain")
+
+        def matches(line):
+            if level and f" - {level.upper()} - " not in line:
+                return False
+            return not contains or contains in line
+
+        # Stat before reading: if the file is rotated in between, the client
+        # holds the old id and restarts from 0 on its next call
+        stat = os.stat(LOG_PATH)
+        size = stat.st_size
+        current_id = f"{stat.st_dev}-{stat.st_ino}"
+        headers = {"X-Log-Size": str(size), "X-Log-Id": current_id}
+        if since_offset is not None:
+            if since_offset > size or (log_id and log_id != current_id):
+                # The file was rotated since the client's last read
+                since_offset = 0
+                headers["X-Log-Rotated"] = "true"
+            lines, next_offset = read_log_from(LOG_PATH, since_offset, LOG_READ_LIMIT)
+            lines = [line for line in lines if matches(line)]
+            if tail:
+                lines = lines[-tail:]
+        else:
+            lines = tail_log(LOG_PATH, min(tail or 1000, LOG_TAIL_LIMIT), matches)
+            next_offset = size
+        headers["X-Log-Offset"] = str(next_offset)
+        return Response("".join(lines), mimetype="text/plain", headers=headers)
     except Exception as e:
         return jsonify({"msg": f"Error fetching logs: {e}"}), 500
 
@@ -593,6 +1123,252 @@ def login():
     else:
         return jsonify({"msg": "Invalid credentials"}), 401
     
+# Snapshot generations shared by all workers through Mongo, re-read at most
+# once per GENERATION_CHECK_INTERVAL
+def current_generations():
+    global _generations, _generations_checked_at
+    now = time.monotonic()
+    if now - _generations_checked_at >= GENERATION_CHECK_INTERVAL:
+        _generations = {
+            doc["_id"]: doc for doc in mongo.db[GENERATIONS_COLLECTION].find({})
+        }
+        _generations_checked_at = now
+    return _generations
+
+def generation_tag(services):
+    generations = current_generations()
+    return tuple(generations.get(svc, {}).get("generation", 0) for svc in services)
+
+def cached_response(key, services, build):
+    """Serve `build()` from the response cache while `services` are unchanged."""
+    tag = generation_tag(services)
+    with _response_cache_lock:
+        entry = _response_cache.get(key)
+        if entry and entry[0] == tag:
+            _response_cache.move_to_end(key)
+    if entry and entry[0] == tag:
+        body = entry[1]
+        if len(body) >= GZIP_MIN_SIZE and "gzip" in request.headers.get("Accept-Encoding", ""):
+            # Compressed once per cache entry instead of on every hit
+            if entry[2] is None:
+                entry[2] = gzip.compress(body, compresslevel=6)
+            response = app.response_class(entry[2], status=200, mimetype="application/json")
+            response.headers["Content-Encoding"] = "gzip"
+            response.headers["Vary"] = "Accept-Encoding"
+            return response
+        return app.response_class(body, status=200, mimetype="application/json")
+
+    response = app.make_response(build())
+    if response.status_code == 200:
+        with _response_cache_lock:
+            _response_cache[key] = [tag, response.get_data(), None]
+            _response_cache.move_to_end(key)
+            while len(_response_cache) > RESPONSE_CACHE_SIZE:
+                _response_cache.popitem(last=False)
+    return response
+
+def generations_last_modified(services):
+    generations = current_generations()
+    stamps = [generations[svc]["updated_at"] for svc in services if generations.get(svc, {}).get("updated_at")]
+    if not stamps:
+        return None
+    last = max(stamps)
+    if last.tzinfo is None:
+        last = last.replace(tzinfo=timezone.utc)
+    return last.replace(microsecond=0)
+
+def conditional_response(services, build):
+    """Answer with 304 when the client's validators still match, else `build()`.
+
+    The ETag covers the snapshot generations of `services` and the full
+    request, so it changes whenever a swap or upsert touches the data.
+    Responses marked no-store get no validators.
+    """
+    tag = generation_tag(services)
+    digest = hashlib.sha1(repr((tag, request.path, sorted(request.args.items(multi=True)))).encode("utf-8"))
+    etag = digest.hexdigest()
+    last_modified = generations_last_modified(services)
+
+    not_modified = not_modified_response(etag, last_modified)
+    if not_modified:
+        return not_modified
+    return add_validators(app.make_response(build()), etag, last_modified)
+
+def not_modified_response(etag, last_modified):
+    """304 when the client's If-None-Match or If-Modified-Since still matches, else None."""
+    if request.if_none_match:
+        if request.if_none_match.contains_weak(etag):
+            return Response(status=304, headers={"ETag": f'W/"{etag}"'})
+    elif request.if_modified_since and last_modified and last_modified <= request.if_modified_since:
+        return Response(status=304, headers={"ETag": f'W/"{etag}"'})
+    return None
+
+def add_validators(response, etag, last_modified):
+    if response.status_code == 200 and "no-store" not in response.headers.get("Cache-Control", ""):
+        response.set_etag(etag, weak=True)
+        if last_modified:
+            response.last_modified = last_modified
+    return response
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+@app.after_request
+def record_request_metrics(response):
+    started = getattr(g, "request_started", None)
+    if started is not None:
+        route = request.url_rule.rule if request.url_rule else "unmatched"
+        labels = {"route": route, "method": request.method}
+        observe("http_request_duration_seconds", time.perf_counter() - started, labels)
+        inc_counter("http_requests_total", {**labels, "status": str(response.status_code)})
+    return response
+
+@app.after_request
+def compress_response(response):
+    """gzip JSON responses above GZIP_MIN_SIZE for clients that accept it."""
+    if response.status_code != 200 or response.direct_passthrough or response.is_streamed:
+        return response
+    if response.mimetype != "application/json" or "Content-Encoding" in response.headers:
+        return response
+    if "gzip" not in request.headers.get("Accept-Encoding", ""):
+        return response
+    data = response.get_data()
+    if len(data) < GZIP_MIN_SIZE:
+        return response
+    response.set_data(gzip.compress(data, compresslevel=6))
+    response.headers["Content-Encoding"] = "gzip"
+    response.headers["Vary"] = "Accept-Encoding"
+    return response
+
+def build_search_index(tag):
+    global _search_index, _search_index_tag, _search_index_building
+    try:
+        games = []
+        for svc in SERVICES:
+            for doc in mongo.db[f"{svc}_games"].find({}, {"_id": 0, "title": 1, "native_id": 1}):
+                games.append((svc, doc.get("title"), doc.get("native_id")))
+        index = TitleIndex(games)
+        with _search_index_lock:
+            _search_index, _search_index_tag = index, tag
+        log_info(f"Search index rebuilt with {len(index)} titles")
+    except Exception as e:
+        log_info(f"Error building search index: {e}")
+    finally:
+        _search_index_building = False
+
+def get_search_index():
+    """Current title index; builds it on first use and refreshes it after swaps."""
+    global _search_index_building
+    tag = generation_tag(SERVICES)
+    with _search_index_lock:
+        index, index_tag = _search_index, _search_index_tag
+        start_rebuild = index is not None and index_tag != tag and not _search_index_building
+        if start_rebuild:
+            _search_index_building = True
+    if index is None:
+        build_search_index(tag)
+        return _search_index
+    if start_rebuild:
+        Thread(target=build_search_index, args=(tag,), daemon=True).start()
+    return index
+
+@app.route('/games/search', methods=['GET'])
+def search_games():
+    auth_result = custom_token_verification()
+    if isinstance(auth_result, tuple):
+        return auth_result
+    query = request.args.get('q', '').strip()
+    service = request.args.get('service')
+    try:
+        limit = min(int(request.args.get('limit', 10)), 100)
+    except ValueError:
+        return jsonify({"msg": "Invalid limit"}), 400
+    if limit < 1:
+        return jsonify({"msg": "Invalid limit"}), 400
+
+    if not query:
+        return jsonify({"msg": "Missing query"}), 400
+    if service and service not in SERVICES:
+        return jsonify({"msg": "Invalid service"}), 400
+
+    index = get_search_index()
+    if index is None:
+        return jsonify({"msg": "Search index not available"}), 503
+    return jsonify({"query": query, "results": index.search(query, limit, service)}), 200
+
+def json_default(value):
+    if isinstance(value, datetime):
+        return value.isoformat()
+    return str(value)
+
+@app.route('/games/export', methods=['GET'])
+def export_games():
+    auth_result = custom_token_verification()
+    if isinstance(auth_result, tuple):
+        return auth_result
+    service = request.args.get('service')
+    fields = [f.strip() for f in request.args.get('fields', '').split(',') if f.strip()]
+    updated_since = request.args.get('updated_since')
+    with_details = request.args.get('details', '').lower() in ('1', 'true', 'yes')
+
+    if service not in SERVICES:
+        return jsonify({"msg": "Invalid service"}), 400
+
+    query = {}
+    if updated_since:
+        try:
+            query["updated_at"] = {"$gte": datetime.fromisoformat(updated_since)}
+        except ValueError:
+            return jsonify({"msg": "Invalid updated_since, expected ISO 8601"}), 400
+
+    collection_name = f"{service}_games"
+    pipeline = [{"$match": query}]
+    if with_details:
+        pipeline += [
+            {"$lookup": {
+                "from": details_collection_name(collection_name),
+                "localField": "title",
+                "foreignField": "title",
+                "as": "details"
+            }},
+            {"$replaceRoot": {"newRoot": {"$mergeObjects": [
+                {"$arrayElemAt": ["$details", 0]}, "$$ROOT"
+            ]}}},
+            {"$project": {"details": 0}}
+        ]
+    if fields:
+        pipeline.append({"$project": {"_id": 0, **{field: 1 for field in fields}}})
+    else:
+        pipeline.append({"$project": {"_id": 0, "content_hash": 0}})
+
+    gzip_accepted = "gzip" in request.headers.get("Accept-Encoding", "")
+
+    def generate():
+        # Stream straight from the cursor, flushing in ~64KB chunks
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 31) if gzip_accepted else None
+        chunk = []
+        size = 0
+        for doc in mongo.db[collection_name].aggregate(pipeline, batchSize=1000):
+            line = json.dumps(doc, default=json_default, ensure_ascii=False) + "\n"
+            chunk.append(line)
+            size += len(line)
+            if size >= 65536:
+                data = "".join(chunk).encode("utf-8")
+                yield compressor.compress(data) if compressor else data
+                chunk, size = [], 0
+        data = "".join(chunk).encode("utf-8")
+        if compressor:
+            yield compressor.compress(data) + compressor.flush()
+        elif data:
+            yield data
+
+    headers = {"Content-Disposition": f"attachment; filename={service}_games.ndjson"}
+    if gzip_accepted:
+        headers["Content-Encoding"] = "gzip"
+        headers["Vary"] = "Accept-Encoding"
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson", headers=headers)
+
 @app.route('/games', methods=['GET'])
 def get_games():
     # Token verification
@@ -600,77 +1376,282 @@ def get_games():
     if isinstance(auth, tuple):
         return auth
 
+    service = request.args.get('service')
+    services = [service] if service in SERVICES else SERVICES
+    key = ("games", tuple(sorted(request.args.items(multi=True))))
+    return conditional_response(services, lambda: cached_response(key, services, build_games_response))
+
+def build_games_response():
     # Parameters
     page = int(request.args.get('page', 1))
     per_page = int(request.args.get('per_page', 10))
     service = request.args.get('service')
     region = request.args.get('region')
+    sort = request.args.get('sort')
+    try:
+        min_price = request.args.get('min_price', type=float)
+        max_price = request.args.get('max_price', type=float)
+    except ValueError:
+        return jsonify({"msg": "Invalid price filter"}), 400
+    if not region and (sort or min_price is not None or max_price is not None):
+        return jsonify({"msg": "Price filters and sorting require a region"}), 400
+    if sort not in (None, "price", "-price"):
+        return jsonify({"msg": "Invalid sort"}), 400
 
-    # Filters by region
+    # Filters by region on the normalized price, served by the price_values index
     filters = {}
+    sort_spec = None
     if region:
-        filters[f"prices.{region}"] = {"$ne": "Free or Not Available"}
+        amount_field = f"price_values.{region}.amount_minor"
+        amount_range = {"$gte": 0}
+        if min_price is not None:
+            amount_range["$gte"] = int(round(min_price * 100))
+        if max_price is not None:
+            amount_range["$lte"] = int(round(max_price * 100))
+        filters[amount_field] = amount_range
+        if sort:
+            sort_spec = [(amount_field, -1 if sort.startswith("-") else 1)]
+
+    # Keyset pagination when a cursor is given (empty cursor = first page)
+    cursor = request.args.get('cursor')
+    if cursor is not None:
+        merged = service not in ["steam", "xbox", "playstation", "nintendo"]
+        fields = sort_fields(sort_spec, merged)
+        try:
+            after = decode_cursor(cursor, fields) if cursor else None
+        except (ValueError, TypeError):
+            return jsonify({"msg": "Invalid cursor"}), 400
+        if merged:
+            if not (sort or min_price is not None or max_price is not None):
+                filters = {}
+            games = paginate_merged(per_page + 1, filters, sort_spec, after=after)
+        else:
+            games = paginate_keyset(mongo.db[f"{service}_games"], per_page, filters, sort_spec, after)
+            for game in games:
+                game['service'] = service
+        has_next = len(games) > per_page
+        games = games[:per_page]
+        next_cursor = encode_cursor(games[-1], fields) if has_next else None
+        for game in games:
+            format_region_price(game, region)
+        return jsonify({
+            "games": games,
+            "has_next": has_next,
+            "next_cursor": next_cursor,
+            "per_page": per_page
+        }), 200
 
     # If specific service requested
     if service in ["steam", "xbox", "playstation", "nintendo"]:
         collection = mongo.db[f"{service}_games"]
-        games = paginate(collection, page, per_page, filters)
+        games = paginate(collection, page, per_page, filters, sort_spec)
         for game in games:
             game['service'] = service
+        has_next = len(games) == per_page
+        total = len(games)
 
     # Merge all services when no specific service
     else:
         try:
-            services = ["steam", "xbox", "playstation", "nintendo"]
-            all_games = []
-            for svc in services:
-                collection = mongo.db[f"{svc}_games"]    # fetch all games regardless of region
-                docs = list(collection.find({}, {"_id": 0}))
-                for game in docs:
-                    game['service'] = svc               # assign service flag
-                    all_games.append(game)
-
-            # Remove duplicates by (service, title)
-            unique = {}
-            for game in all_games:
-                key = f"{game['service']}:{game.get('title','')}"
-                unique.setdefault(key, game)
-            deduped = list(unique.values())
-
-            # Pagination on deduped list
-            start = (page - 1) * per_page
-            if start >= len(deduped):
-                return jsonify({
-                    "games": [],
-                    "has_next": False,
-                    "has_prev": page > 1,
-                    "page": page,
-                    "per_page": per_page,
-                    "total": len(deduped)
-                }), 200
-            games = deduped[start:start + per_page]
-
+            # Region only narrows the merged view when filtering or sorting on price
+            merged_filters = filters if (sort or min_price is not None or max_price is not None) else {}
+            games = paginate_merged(per_page, merged_filters, sort_spec, skip=(page - 1) * per_page)
+            total = count_merged(merged_filters)
+            has_next = (page - 1) * per_page + len(games) < total
         except Exception as e:
             log_info(f"Error in combined query: {e}")
             return jsonify({"msg": f"Error fetching all services: {e}"}), 500
 
     # Prices by region handling
     for game in games:
-        if region and 'prices' in game and region in game['prices']:
-            game['region'] = region
-            game['price'] = game['prices'].pop(region)
-        elif 'prices' in game:
-            game['regions'] = list(game['prices'].keys())
+        format_region_price(game, region)
 
     return jsonify({
         "games": games,
-        "has_next": len(games) == per_page,
+        "has_next": has_next,
         "has_prev": page > 1,
         "page": page,
         "per_page": per_page,
-        "total": len(games)
+        "total": total
     }), 200
 
+def load_stored_game(service, query, with_hash=False):
+    """Stored game with its heavy fields from the details collection."""
+    collection_name = f"{service}_games"
+    game = mongo.db[collection_name].find_one(query, {"_id": 0} if with_hash else {"_id": 0, "content_hash": 0})
+    if not game:
+        return None
+    details = mongo.db[details_collection_name(collection_name)].find_one(
+        {"title": game["title"]}, {"_id": 0, "title": 0, "native_id": 0}
+    )
+    if details:
+        game.update(details)
+    game['service'] = service
+    return game
+
+def is_fresh(game, service):
+    fetched_at = game.get("fetched_at")
+    if not isinstance(fetched_at, datetime):
+        return False
+    if fetched_at.tzinfo is None:
+        fetched_at = fetched_at.replace(tzinfo=timezone.utc)
+    return datetime.now(timezone.utc) - fetched_at < timedelta(seconds=FRESHNESS_TTL[service])
+
+def wait_for_job(job_id, timeout):
+    """Poll a refresh job (possibly run by another worker) until it finishes."""
+    jobs = mongo.db[REFRESH_JOBS_COLLECTION]
+    deadline = time.monotonic() + timeout
+    while True:
+        job = jobs.find_one({"_id": job_id})
+        if not job or not job.get("active") or time.monotonic() >= deadline:
+            return job
+        time.sleep(0.25)
+
+def refresh_game(service, title, region):
+    """Scrape one title live and upsert it into the service collection."""
+    # Scraper modules (and Selenium/bs4 behind them) are only imported when a live scrape is needed
+    if service == 'steam':
+        from scraper_steam import fetch_steam_game_by_title
+        game = fetch_steam_game_by_title(title, region)
+    elif service == 'xbox':
+        from scraper_xbox import fetch_xbox_game_by_title
+        game = fetch_xbox_game_by_title(title)
+    elif service == 'playstation':
+        from scraper_playstation import fetch_playstation_game_by_title
+        game = fetch_playstation_game_by_title(title)
+    else:
+        from scraper_nintendo import fetch_nintendo_game_by_title
+        game = fetch_nintendo_game_by_title(title)
+
+    if not game:
+        return None
+
+    game['service'] = service
+    game['region'] = region
+    game.setdefault('fetched_at', datetime.now(timezone.utc))
+
+    collection_name = f"{service}_games"
+    stored = mongo.db[collection_name].find_one(
+        {"title": game.get("title")}, {"_id": 0, "content_hash": 1, "updated_at": 1}
+    )
+    if stored and stored.get("content_hash") == game.get("content_hash") and stored.get("updated_at"):
+        game['updated_at'] = stored["updated_at"]
+    else:
+        game['updated_at'] = game['fetched_at']
+    lean, details = split_game_document(game)
+    mongo.db[collection_name].update_one(
+        {"title": game.get("title")},
+        {"$set": lean, "$unset": {field: "" for field in HEAVY_FIELDS}},
+        upsert=True
+    )
+    if details:
+        mongo.db[details_collection_name(collection_name)].update_one(
+            {"title": game.get("title")},
+            {"$set": details},
+            upsert=True
+        )
+    bump_generation(mongo.db, collection_name)
+    return game
+
+def run_refresh_job(job_id, service, title, region):
+    global _refresh_pending
+    jobs = mongo.db[REFRESH_JOBS_COLLECTION]
+    jobs.update_one({"_id": job_id}, {"$set": {"status": "running", "started_at": datetime.now(timezone.utc)}})
+    update = {}
+    try:
+        game = refresh_game(service, title, region)
+        if game:
+            game.pop("_id", None)
+            update.update({"status": "done", "result": game})
+        else:
+            update.update({"status": "not_found"})
+    except Exception as e:
+        log_info(f"Refresh job {job_id} ({service}: {title}) failed: {e}")
+        update.update({"status": "failed", "error": str(e)})
+    finally:
+        update["finished_at"] = datetime.now(timezone.utc)
+        jobs.update_one({"_id": job_id}, {"$set": update, "$unset": {"active": ""}})
+        with _refresh_lock:
+            _refresh_pending -= 1
+
+def enqueue_refresh(service, title, region):
+    """Start a refresh job, or attach to the one already running for the same key.
+
+    Returns (job, created). The partial unique index on `key` lets only one
+    active job per (service, title, region) exist across all workers.
+    """
+    global _refresh_pending
+    jobs = mongo.db[REFRESH_JOBS_COLLECTION]
+    ensure_refresh_job_indexes()
+    key = f"{service}:{title}:{region or ''}"
+    now = datetime.now(timezone.utc)
+
+    # Jobs left active by a worker that died are expired so they cannot block refreshes
+    jobs.update_many(
+        {"key": key, "active": True, "created_at": {"$lt": now - timedelta(seconds=REFRESH_JOB_TIMEOUT)}},
+        {"$set": {"status": "failed", "error": "timed out"}, "$unset": {"active": ""}}
+    )
+
+    job = {
+        "_id": uuid.uuid4().hex,
+        "key": key,
+        "service": service,
+        "title": title,
+        "region": region,
+        "status": "queued",
+        "active": True,
+        "created_at": now
+    }
+    # Attaching to a running job needs no queue slot, so look for one first
+    existing = jobs.find_one({"key": key, "active": True})
+    if existing:
+        return existing, False
+
+    # Reserve the slot under the lock and insert outside it
+    with _refresh_lock:
+        if _refresh_pending >= REFRESH_QUEUE_LIMIT:
+            raise OverflowError("Refresh queue is full")
+        _refresh_pending += 1
+    inserted = False
+    try:
+        jobs.insert_one(job)
+        inserted = True
+    except DuplicateKeyError:
+        existing = jobs.find_one({"key": key, "active": True})
+        if existing:
+            return existing, False
+        raise
+    finally:
+        if not inserted:
+            with _refresh_lock:
+                _refresh_pending -= 1
+    _refresh_executor.submit(run_refresh_job, job["_id"], service, title, region)
+    return job, True
+
+def ensure_refresh_job_indexes():
+    global _refresh_indexes_ready
+    if _refresh_indexes_ready:
+        return
+    jobs = mongo.db[REFRESH_JOBS_COLLECTION]
+    jobs.create_index("key", unique=True, partialFilterExpression={"active": True})
+    jobs.create_index("created_at", expireAfterSeconds=REFRESH_JOB_RETENTION)
+    _refresh_indexes_ready = True
+
+def job_response(job):
+    payload = {
+        "job_id": job["_id"],
+        "status": job["status"],
+        "service": job["service"],
+        "title": job["title"],
+        "region": job.get("region"),
+        "status_url": f"/game/jobs/{job['_id']}"
+    }
+    if job.get("result") is not None:
+        payload["result"] = job["result"]
+    if job.get("error"):
+        payload["error"] = job["error"]
+    return payload
+
 @app.route('/game', methods=['GET'])
 def update_game():
     auth_result = custom_token_verification()
@@ -679,41 +1660,201 @@ def update_game():
     title = request.args.get('title')
     service = request.args.get('service')
     region = request.args.get('region')
-    
+
+    if service not in SERVICES:
+        return jsonify({"msg": "Invalid service"}), 400
+    if not title:
+        return jsonify({"msg": "Missing title"}), 400
+    if service == 'steam':
+        region = request.args.get('region', 'ru')
     try:
-        if service == 'steam':
-            region = request.args.get('region', 'ru')
-            game = fetch_steam_game_by_title(title, region)
-        elif service == 'xbox':
-            game = fetch_xbox_game_by_title(title)
-        elif service == 'playstation':
-            game = fetch_playstation_game_by_title(title)
-        elif service == 'nintendo':
-            game = fetch_nintendo_game_by_title(title)
-        else:
-            return jsonify({"msg": "Invalid service"}), 400
+        record_game_request(mongo.db, service, title)
     except Exception as e:
-        return jsonify({"msg": f"Error fetching game from {service}: {e}"}), 500
-    
-    if not game:
-        return jsonify({"msg": "Game not found"}), 404
+        log_info(f"Recording /game request for {title} failed: {e}")
+    force_refresh = request.args.get('refresh', '').lower() in ('1', 'true', 'yes')
+    if force_refresh:
+        return serve_game(service, title, region, None, force_refresh)
 
-    game['service'] = service
-    game['region'] = region
+    stored = load_stored_game(service, {"title": title}, with_hash=True)
+    etag, last_modified = game_validators(service, stored)
+    if etag:
+        not_modified = not_modified_response(etag, last_modified)
+        if not_modified:
+            return not_modified
+    if stored:
+        stored.pop("content_hash", None)
+    response = app.make_response(serve_game(service, title, region, stored))
+    return add_validators(response, etag, last_modified) if etag else response
 
+def game_validators(service, stored):
+    """ETag and Last-Modified of the stored copy of a game.
+
+    Only a fresh stored copy gets validators, so a client can never
+    revalidate a miss or a copy that is due for a refresh.
+    """
+    if not stored or not is_fresh(stored, service):
+        return None, None
+    fetched_at = stored["fetched_at"]
+    if fetched_at.tzinfo is None:
+        fetched_at = fetched_at.replace(tzinfo=timezone.utc)
+    key = (stored.get("content_hash"), fetched_at.isoformat(), request.path, sorted(request.args.items(multi=True)))
+    return hashlib.sha1(repr(key).encode("utf-8")).hexdigest(), fetched_at.replace(microsecond=0)
+
+def serve_game(service, title, region, stored, force_refresh=False):
+    """Stored, stale-while-revalidate or live copy of a game (see /game).
+
+    Only fresh stored copies may be revalidated by clients; everything else
+    is marked no-store so a 304 never hides a pending refresh.
+    """
+    # Serve the stored copy when it is fresh; when stale, serve it and refresh in the background
+    if stored and is_fresh(stored, service):
+        stored['region'] = region
+        stored['freshness'] = "fresh"
+        return jsonify(stored), 200
 
-    collection_name = f"{service}_games"
     try:
-        mongo.db[collection_name].update_one(
-            {"title": game.get("title")},
-            {"$set": game},
-            upsert=True
-        )
+        job, created = enqueue_refresh(service, title, region)
+    except OverflowError as e:
+        if stored:
+            stored['region'] = region
+            stored['freshness'] = "stale"
+            return jsonify(stored), 200, NO_STORE
+        return jsonify({"msg": str(e)}), 503
     except Exception as e:
-        return jsonify({"msg": f"Mongo update failed: {e}"}), 500
+        return jsonify({"msg": f"Error queueing refresh for {service}: {e}"}), 500
+
+    if stored:
+        stored['region'] = region
+        stored['freshness'] = "stale"
+        stored['refresh_job_id'] = job["_id"]
+        return jsonify(stored), 200, NO_STORE
+
+    finished = None
+    if not force_refresh:
+        # Miss: wait briefly for the live scrape, up to GAME_WAIT_TIMEOUT
+        finished = wait_for_job(job["_id"], GAME_WAIT_TIMEOUT)
+        if finished and finished["status"] == "done":
+            game = finished["result"]
+            game['freshness'] = "live"
+            return jsonify(game), 200, NO_STORE
+        if finished and finished["status"] == "not_found":
+            return jsonify({"msg": "Game not found"}), 404
+        if finished and finished["status"] == "failed":
+            return jsonify({"msg": f"Error fetching game from {service}: {finished.get('error')}"}), 500
+
+    payload = job_response(finished or job)
+    payload["attached"] = not created
+    return jsonify(payload), 202
+
+@app.route('/game/jobs/<job_id>', methods=['GET'])
+def get_refresh_job(job_id):
+    auth_result = custom_token_verification()
+    if isinstance(auth_result, tuple):
+        return auth_result
+    job = mongo.db[REFRESH_JOBS_COLLECTION].find_one({"_id": job_id})
+    if not job:
+        return jsonify({"msg": "Job not found"}), 404
+    return jsonify(job_response(job)), 200
+
+@app.route('/game/details', methods=['GET'])
+def get_game_details():
+    auth_result = custom_token_verification()
+    if isinstance(auth_result, tuple):
+        return auth_result
+    service = request.args.get('service')
+    title = request.args.get('title')
+    native_id = request.args.get('native_id')
 
+    if service not in ["steam", "xbox", "playstation", "nintendo"]:
+        return jsonify({"msg": "Invalid service"}), 400
+    if not title and not native_id:
+        return jsonify({"msg": "Missing title or native_id"}), 400
+
+    query = {"title": title} if title else {"native_id": native_id}
+    game = load_stored_game(service, query)
+    if not game:
+        return jsonify({"msg": "Game not found"}), 404
     return jsonify(game), 200
 
+@app.route('/games/compare', methods=['GET'])
+def compare_game():
+    auth_result = custom_token_verification()
+    if isinstance(auth_result, tuple):
+        return auth_result
+    link_id = request.args.get('id')
+    service = request.args.get('service')
+    title = request.args.get('title')
+    native_id = request.args.get('native_id')
+
+    if link_id:
+        query = {"_id": link_id}
+    elif service in SERVICES and (title or native_id):
+        member = {"service": service}
+        if native_id:
+            member["native_id"] = native_id
+        else:
+            member["title"] = title
+        query = {"members": {"$elemMatch": member}}
+    else:
+        return jsonify({"msg": "Missing id, or service with title or native_id"}), 400
+
+    link = mongo.db[LINKS_COLLECTION].find_one(query)
+    if not link:
+        return jsonify({"msg": "Game not found"}), 404
+    link["id"] = link.pop("_id")
+    return jsonify(link), 200
+
+@app.route('/game/prices/history', methods=['GET'])
+def get_price_history():
+    auth_result = custom_token_verification()
+    if isinstance(auth_result, tuple):
+        return auth_result
+    service = request.args.get('service')
+    native_id = request.args.get('native_id')
+    title = request.args.get('title')
+    region = request.args.get('region')
+    since = request.args.get('since')
+    try:
+        limit = min(int(request.args.get('limit', 1000)), 10000)
+    except ValueError:
+        return jsonify({"msg": "Invalid limit"}), 400
+    if limit < 1:
+        return jsonify({"msg": "Invalid limit"}), 400
+
+    if service not in ["steam", "xbox", "playstation", "nintendo"]:
+        return jsonify({"msg": "Invalid service"}), 400
+    if not native_id and not title:
+        return jsonify({"msg": "Missing native_id or title"}), 400
+
+    if not native_id:
+        game = mongo.db[f"{service}_games"].find_one({"title": title}, {"_id": 0, "native_id": 1})
+        if not game or not game.get("native_id"):
+            return jsonify({"msg": "Game not found"}), 404
+        native_id = game["native_id"]
+
+    query = {"meta.store": service, "meta.native_id": native_id}
+    if region:
+        query["meta.region"] = region
+    if since:
+        try:
+            query["ts"] = {"$gte": datetime.fromisoformat(since)}
+        except ValueError:
+            return jsonify({"msg": "Invalid since, expected ISO 8601"}), 400
+
+    # The latest `limit` changes, returned oldest first
+    history = []
+    for doc in mongo.db[PRICE_HISTORY_COLLECTION].find(query, {"_id": 0}).sort("ts", -1).limit(limit):
+        history.append({
+            "region": doc["meta"].get("region"),
+            "price": doc.get("price"),
+            "amount_minor": doc.get("amount_minor"),
+            "currency": doc.get("currency"),
+            "ts": doc["ts"].isoformat(),
+        })
+    history.reverse()
+
+    return jsonify({"service": service, "native_id": native_id, "history": history}), 200
+
 @app.route('/steam/invite', methods=['POST'])
 def invite_friend():
     auth_result = custom_token_verification()
@@ -761,19 +1902,185 @@ def purchase_game():
         return jsonify({"msg": "Missing game title or friend username"}), 400
     
     try:
-        steam_purchase(title, friend)
+        timings = steam_purchase(title, friend)
+    except SteamStepError as e:
+        return jsonify({"msg": "This game can not be delivered because of some reason", "failed_step": e.step, "timings_ms": e.timings}), 200
     except Exception as e:
         return jsonify({"msg": "This game can not be delivered because of some reason"}), 200
     
-    return jsonify({"msg": "Purchase initiated"}), 200
+    return jsonify({"msg": "Purchase initiated", "timings_ms": timings}), 200
+
+# Helper functions to read the log without loading the whole file
+def tail_log(path, count, matches=None, block_size=8192):
+    """Last `count` matching lines, read backwards from the end of the file."""
+    lines = []
+    scanned = 0
+    with open(path, "rb") as f:
+        f.seek(0, os.SEEK_END)
+        position = f.tell()
+        remainder = b""
+        while position > 0 and len(lines) < count and scanned < LOG_SCAN_LIMIT:
+            step = min(block_size, position)
+            position -= step
+            f.seek(position)
+            block = f.read(step) + remainder
+            scanned += step
+            parts = block.split(b"\n")
+            # The first part may be cut off; keep it for the next block
+            remainder = parts.pop(0) if position > 0 else b""
+            for raw in reversed(parts):
+                if not raw:
+                    continue
+                line = raw.decode("utf-8", errors="replace") + "\n"
+                if matches is None or matches(line):
+                    lines.append(line)
+                    if len(lines) >= count:
+                        break
+        if position == 0 and remainder and len(lines) < count:
+            line = remainder.decode("utf-8", errors="replace") + "\n"
+            if matches is None or matches(line):
+                lines.append(line)
+    return list(reversed(lines))
+
+def read_log_from(path, offset, limit):
+    """Complete lines starting at byte `offset`, up to `limit` bytes.
+
+    Returns (lines, next_offset); next_offset points after the last complete line.
+    """
+    with open(path, "rb") as f:
+        f.seek(offset)
+        data = f.read(limit)
+    end = data.rfind(b"\n") + 1
+    data = data[:end]
+    lines = [line + "\n" for line in data.decode("utf-8", errors="replace").split("\n")[:-1]]
+    return lines, offset + end
+
+# Helper function to shape the prices of a listed game for the requested region
+def format_region_price(game, region):
+    price_values = game.pop('price_values', None) or {}
+    if region and 'prices' in game and region in game['prices']:
+        game['region'] = region
+        game['price'] = game['prices'].pop(region)
+        game['price_value'] = price_values.get(region)
+    elif 'prices' in game:
+        game['regions'] = list(game['prices'].keys())
 
 # Helper function to paginate results
-def paginate(collection, page, per_page, filters=None):
+def paginate(collection, page, per_page, filters=None, sort=None):
     query = {}
     if filters:
         query = filters
-    results = list(collection.find(query, {"_id": 0}).skip((page - 1) * per_page).limit(per_page))
+    cursor = collection.find(query, LIST_PROJECTION)
+    if sort:
+        cursor = cursor.sort(sort)
+    results = list(cursor.skip((page - 1) * per_page).limit(per_page))
     return results
 
+def sort_fields(sort=None, merged=False):
+    """Full sort order of a listing: the requested sort, then title (unique
+    per service), then service for the merged view. The tiebreakers follow
+    the direction of the requested sort, so the (amount, title) index of
+    the region serves both price orders."""
+    fields = list(sort or [])
+    direction = fields[0][1] if fields else 1
+    fields.append(("title", direction))
+    if merged:
+        fields.append(("service", direction))
+    return fields
+
+def encode_cursor(game, fields):
+    values = []
+    for field, _ in fields:
+        value = game
+        for part in field.split("."):
+            value = value.get(part) if isinstance(value, dict) else None
+        values.append(value)
+    return base64.urlsafe_b64encode(json.dumps(values).encode("utf-8")).decode("ascii")
+
+def decode_cursor(cursor, fields):
+    """Map of sort field -> value of the last game on the previous page."""
+    values = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    if not isinstance(values, list) or len(values) != len(fields):
+        raise ValueError("cursor does not match the requested sort")
+    # Values go into the query as-is, so operator documents must not get through
+    if any(value is not None and not isinstance(value, (str, int, float)) for value in values):
+        raise ValueError("cursor values must be scalars")
+    return {field: value for (field, _), value in zip(fields, values)}
+
+def keyset_filter(fields, after, constants=None):
+    """Filter for documents strictly after `after` in the order of `fields`.
+
+    constants holds fields whose value is the same for every document of
+    the queried collection (service in the merged view); they are compared
+    here instead of in Mongo.
+    """
+    constants = constants or {}
+    clauses = []
+    for i, (field, direction) in enumerate(fields):
+        clause = {}
+        reachable = True
+        for prev_field, _ in fields[:i]:
+            if prev_field in constants:
+                reachable = reachable and constants[prev_field] == after[prev_field]
+            else:
+                clause[prev_field] = after[prev_field]
+        if field in constants:
+            value = constants[field]
+            reachable = reachable and (value > after[field] if direction == 1 else value < after[field])
+        else:
+            clause[field] = {"$gt" if direction == 1 else "$lt": after[field]}
+        if reachable:
+            clauses.append(clause)
+    return {"$or": clauses} if clauses else {"_id": {"$exists": False}}
+
+def paginate_keyset(collection, per_page, filters=None, sort=None, after=None):
+    """Up to per_page + 1 games following `after`, using range queries only."""
+    fields = sort_fields(sort)
+    query = filters or {}
+    if after:
+        query = {"$and": [query, keyset_filter(fields, after)]}
+    return list(collection.find(query, LIST_PROJECTION).sort(fields).limit(per_page + 1))
+
+def paginate_merged(limit, filters=None, sort=None, skip=0, after=None):
+    """One page of the merged view over all services, computed in Mongo.
+
+    Every service contributes at most skip + limit games in sort order
+    (served by the title or price_values index) through $unionWith, so the
+    cost grows with the page depth rather than the catalog size, and not
+    at all when paging with a keyset `after`. Titles are unique per
+    service, so (service, title) needs no further de-duplication.
+    """
+    services = ["steam", "xbox", "playstation", "nintendo"]
+    query = filters or {}
+    fields = sort_fields(sort, merged=True)
+
+    def service_pipeline(svc):
+        match = query
+        if after:
+            match = {"$and": [query, keyset_filter(fields, after, {"service": svc})]}
+        return [
+            {"$match": match},
+            {"$sort": {k: v for k, v in fields if k != "service"}},
+            {"$limit": skip + limit},
+            {"$project": LIST_PROJECTION},
+            {"$addFields": {"service": svc}},
+        ]
+
+    pipeline = service_pipeline(services[0])
+    for svc in services[1:]:
+        pipeline.append({"$unionWith": {"coll": f"{svc}_games", "pipeline": service_pipeline(svc)}})
+    pipeline += [
+        {"$sort": dict(fields)},
+        {"$skip": skip},
+        {"$limit": limit},
+    ]
+    return list(mongo.db[f"{services[0]}_games"].aggregate(pipeline))
+
+def count_merged(filters=None):
+    services = ["steam", "xbox", "playstation", "nintendo"]
+    if filters:
+        return sum(mongo.db[f"{svc}_games"].count_documents(filters) for svc in services)
+    return sum(mongo.db[f"{svc}_games"].estimated_document_count() for svc in services)
+
 if __name__ == '__main__':
     app.run(host=access_ip, port=server_port, debug=False)
\ No newline at end of file
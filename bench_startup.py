@@ -0,0 +1,81 @@
+"""
+Startup benchmark: import time and peak memory of each entry point, each
+measured in a fresh interpreter.
+
+    python bench_startup.py [--runs 5] [--top 5] [module ...]
+"""
+import os
+import sys
+import argparse
+import statistics
+import subprocess
+import time
+
+ENTRY_POINTS = [
+    "api_server",
+    "scheduler",
+    "utils",
+    "scraper_steam",
+    "scraper_nintendo",
+    "scraper_xbox",
+    "scraper_playstation",
+]
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+PROBE = "import resource, {module}; print(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)"
+
+def parse_importtime(stderr, top):
+    """Heaviest imports made directly by the entry point, by cumulative time."""
+    direct = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|", 2)
+        name = name[1:]
+        # Direct imports of the entry point are indented by exactly two spaces
+        if name.startswith("  ") and not name.startswith("   "):
+            direct.append((int(cumulative.strip()), name.strip()))
+    return sorted(direct, reverse=True)[:top]
+
+def measure(module, runs, top):
+    env = dict(os.environ)
+    env.setdefault("MONGO_URI", "mongodb://127.0.0.1:27017/bench")
+    wall, rss, heaviest = [], [], []
+    for _ in range(runs):
+        started = time.perf_counter()
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", PROBE.format(module=module)],
+            cwd=BASE_DIR, env=env, capture_output=True, text=True
+        )
+        wall.append(time.perf_counter() - started)
+        if result.returncode != 0:
+            return {"module": module, "error": result.stderr.strip().splitlines()[-1:]}
+        rss.append(int(result.stdout.strip().splitlines()[-1]))
+        heaviest = parse_importtime(result.stderr, top)
+    return {
+        "module": module,
+        "wall_ms": statistics.median(wall) * 1000,
+        "max_rss_mb": statistics.median(rss) / 1024,
+        "heaviest": heaviest,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("modules", nargs="*", default=ENTRY_POINTS)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"{'entry point':<22}{'import (ms)':>12}{'max rss (MB)':>14}")
+    for module in args.modules:
+        result = measure(module, args.runs, args.top)
+        if "error" in result:
+            print(f"{module:<22} failed: {' '.join(result['error'])}")
+            continue
+        print(f"{module:<22}{result['wall_ms']:>12.0f}{result['max_rss_mb']:>14.1f}")
+        for cumulative, name in result["heaviest"]:
+            print(f"{'':<4}{name:<30}{cumulative / 1000:>8.1f} ms")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+import os
+import uuid
+from datetime import datetime, timedelta, timezone
+from pymongo.errors import DuplicateKeyError
+from utils import log_info, details_collection_name
+from priority import plan_refresh
+
+# One document per crawl run and one per item the run has finished. A run
+# stays "running" until its snapshot is swapped in; a crashed or stopped
+# run is resumed by the next start of the same scraper.
+CRAWL_RUNS_COLLECTION = "crawl_runs"
+CRAWL_ITEMS_COLLECTION = "crawl_items"
+
+# Older unfinished runs are abandoned instead of resumed
+CRAWL_RUN_MAX_AGE = timedelta(hours=float(os.getenv("CRAWL_RUN_MAX_AGE_HOURS", "72")))
+
+def begin_crawl(db, collection_name):
+    """Resume the service's unfinished run or start a new one with an empty
+    tmp snapshot. Returns (run_id, native ids already done in the run)."""
+    service = collection_name.replace("_games", "")
+    runs = db[CRAWL_RUNS_COLLECTION]
+    items = db[CRAWL_ITEMS_COLLECTION]
+    items.create_index("run_id")
+
+    run = runs.find_one({"service": service, "status": "running"})
+    now = datetime.now(timezone.utc)
+    if run:
+        started_at = run["started_at"]
+        if started_at.tzinfo is None:
+            started_at = started_at.replace(tzinfo=timezone.utc)
+        if now - started_at <= CRAWL_RUN_MAX_AGE and f"{collection_name}_tmp" in db.list_collection_names():
+            done = {doc["native_id"] for doc in items.find({"run_id": run["_id"]}, {"_id": 0, "native_id": 1})}
+            runs.update_one({"_id": run["_id"]}, {"$set": {"resumed_at": now}, "$inc": {"attempts": 1}})
+            log_info(f"{service}: resuming crawl {run['_id']} with {len(done)} games already done")
+            return run["_id"], done
+        abandon_crawl(db, run["_id"])
+
+    db[f"{collection_name}_tmp"].drop()
+    db[f"{details_collection_name(collection_name)}_tmp"].drop()
+    run_id = uuid.uuid4().hex
+    runs.insert_one({
+        "_id": run_id,
+        "service": service,
+        "status": "running",
+        "started_at": now,
+        "attempts": 1,
+    })
+    log_info(f"{service}: starting crawl {run_id}")
+    return run_id, set()
+
+def plan_crawl(db, run_id, collection_name, items, native_id_of, requests_per_item=1):
+    """The run's refresh plan (see priority.plan_refresh), made once and kept
+    on the run, so a resumed run finishes the games it started with instead
+    of spending a new budget."""
+    runs = db[CRAWL_RUNS_COLLECTION]
+    run = runs.find_one({"_id": run_id}, {"planned": 1, "planned_ids": 1})
+    if run and run.get("planned"):
+        if run.get("planned_ids") is None:
+            return items
+        planned_ids = set(run["planned_ids"])
+        return [item for item in items if native_id_of(item) in planned_ids]
+
+    selected = plan_refresh(db, collection_name, items, native_id_of, requests_per_item)
+    # A plan that kept every listed game is stored as None rather than as ids
+    planned_ids = [native_id_of(item) for item in selected] if len(selected) < len(items) else None
+    runs.update_one({"_id": run_id}, {"$set": {"planned": True, "planned_ids": planned_ids}})
+    return selected
+
+def remaining_items(db, run_id, done, items, native_id_of):
+    """Items not yet done in the run; records how many distinct games the run covers."""
+    pending = [item for item in items if native_id_of(item) not in done]
+    expected = len(done | {native_id_of(item) for item in pending})
+    db[CRAWL_RUNS_COLLECTION].update_one({"_id": run_id}, {"$set": {"expected": expected}})
+    return pending
+
+def record_done(db, run_id, native_id):
+    try:
+        db[CRAWL_ITEMS_COLLECTION].insert_one({"_id": f"{run_id}:{native_id}", "run_id": run_id, "native_id": native_id})
+    except DuplicateKeyError:
+        pass
+
+def crawl_complete(db, run_id):
+    run = db[CRAWL_RUNS_COLLECTION].find_one({"_id": run_id}, {"expected": 1})
+    done = db[CRAWL_ITEMS_COLLECTION].count_documents({"run_id": run_id})
+    return bool(run) and done >= run.get("expected", 0)
+
+def finish_crawl(db, run_id):
+    db[CRAWL_RUNS_COLLECTION].update_one(
+        {"_id": run_id},
+        {"$set": {"status": "complete", "finished_at": datetime.now(timezone.utc)}}
+    )
+    db[CRAWL_ITEMS_COLLECTION].delete_many({"run_id": run_id})
+
+def abandon_crawl(db, run_id):
+    db[CRAWL_RUNS_COLLECTION].update_one(
+        {"_id": run_id},
+        {"$set": {"status": "abandoned", "finished_at": datetime.now(timezone.utc)}}
+    )
+    db[CRAWL_ITEMS_COLLECTION].delete_many({"run_id": run_id})
+    log_info(f"Abandoned crawl {run_id}")
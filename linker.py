@@ -0,0 +1,195 @@
+import re
+import uuid
+import hashlib
+from datetime import datetime, timezone
+from search_index import normalize_title, trigrams
+from utils import log_info, get_mongo_db
+
+LINKS_COLLECTION = "game_links"
+SERVICES = ["steam", "xbox", "playstation", "nintendo"]
+
+# Trigram similarity above which two titles from different stores are the
+# same game; between the two thresholds publisher or release year must agree.
+SAME_TITLE_SIMILARITY = 0.9
+CANDIDATE_SIMILARITY = 0.7
+
+# Prefix blocks larger than this are only linked on exact canonical titles
+MAX_BLOCK_SIZE = 500
+
+# Store and platform noise that does not distinguish games
+NOISE = re.compile(
+    r"\b(standard edition|for nintendo switch|nintendo switch edition|nintendo switch|"
+    r"xbox series x s|xbox series x|xbox one|windows|pc|ps4 ps5|ps5 ps4|ps4|ps5|"
+    r"playstation 4|playstation 5)\b"
+)
+PUBLISHER_NOISE = re.compile(r"\b(inc|ltd|llc|co|corp|corporation|entertainment|games|studios?|interactive)\b")
+
+def canonical_title(title: str) -> str:
+    return re.sub(r"\s+", " ", NOISE.sub(" ", normalize_title(title))).strip()
+
+def publisher_tokens(publisher) -> set:
+    if isinstance(publisher, list):
+        publisher = " ".join(str(p) for p in publisher)
+    return set(PUBLISHER_NOISE.sub(" ", normalize_title(str(publisher or ""))).split())
+
+def release_year(release_date):
+    match = re.search(r"\b(19|20)\d{2}\b", str(release_date or ""))
+    return int(match.group()) if match else None
+
+def blocking_keys(key: str) -> set:
+    """Keys that put likely matches in the same block: the full canonical
+    title and its first two words."""
+    words = key.split()
+    return {f"t:{key}", f"p:{' '.join(words[:2])}"}
+
+def is_match(a: dict, b: dict) -> bool:
+    if a["key"] == b["key"]:
+        return True
+    union = len(a["grams"] | b["grams"])
+    similarity = len(a["grams"] & b["grams"]) / union if union else 0
+    if similarity >= SAME_TITLE_SIMILARITY:
+        return True
+    if similarity < CANDIDATE_SIMILARITY:
+        return False
+    same_publisher = bool(a["publisher"] & b["publisher"])
+    same_year = a["year"] is not None and a["year"] == b["year"]
+    return same_publisher or same_year
+
+def load_games(db) -> list[dict]:
+    games = []
+    projection = {"_id": 0, "title": 1, "native_id": 1, "publisher": 1, "release_date": 1,
+                  "prices": 1, "price_values": 1, "url": 1}
+    for service in SERVICES:
+        for doc in db[f"{service}_games"].find({}, projection).batch_size(5000):
+            key = canonical_title(doc.get("title"))
+            if not key:
+                continue
+            games.append({
+                "service": service,
+                "doc": doc,
+                "key": key,
+                "grams": trigrams(key),
+                "publisher": publisher_tokens(doc.get("publisher")),
+                "year": release_year(doc.get("release_date")),
+            })
+    return games
+
+def cluster_games(games: list[dict]) -> list[list[int]]:
+    """Union-find over matching pairs from different stores within each block.
+
+    A union that would put two games of the same store into one cluster is
+    rejected, so matches can't chain two store entries together.
+    """
+    parent = list(range(len(games)))
+    services = [{game["service"]} for game in games]
+
+    def find(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    blocks = {}
+    for i, game in enumerate(games):
+        for block_key in blocking_keys(game["key"]):
+            blocks.setdefault(block_key, []).append(i)
+
+    for block_key, members in blocks.items():
+        if len(members) < 2 or (block_key.startswith("p:") and len(members) > MAX_BLOCK_SIZE):
+            continue
+        for x in range(len(members)):
+            for y in range(x + 1, len(members)):
+                a, b = games[members[x]], games[members[y]]
+                if a["service"] == b["service"]:
+                    continue
+                root_a, root_b = find(members[x]), find(members[y])
+                if root_a == root_b or services[root_a] & services[root_b]:
+                    continue
+                if is_match(a, b):
+                    parent[root_b] = root_a
+                    services[root_a] |= services[root_b]
+
+    clusters = {}
+    for i in range(len(games)):
+        clusters.setdefault(find(i), []).append(i)
+    return list(clusters.values())
+
+def link_document(games: list[dict], members: list[int], now) -> dict:
+    entries = sorted((games[i] for i in members), key=lambda g: (g["key"], g["service"]))
+    key = entries[0]["key"]
+    prices = {}
+    for game in entries:
+        doc = game["doc"]
+        store_prices = {}
+        for region, display in (doc.get("prices") or {}).items():
+            value = (doc.get("price_values") or {}).get(region) or {}
+            store_prices[region] = {"price": display, **value}
+        prices.setdefault(game["service"], {})[doc.get("native_id") or doc.get("title")] = store_prices
+    return {
+        "_id": hashlib.sha1(key.encode("utf-8")).hexdigest()[:16],
+        "key": key,
+        "title": entries[0]["doc"].get("title"),
+        "services": sorted({g["service"] for g in entries}),
+        "members": [
+            {
+                "service": g["service"],
+                "title": g["doc"].get("title"),
+                "native_id": g["doc"].get("native_id"),
+                "url": g["doc"].get("url"),
+            }
+            for g in entries
+        ],
+        "prices": prices,
+        "linked_at": now,
+    }
+
+def link_games(db=None):
+    """Rebuild the game_links collection from the current snapshots."""
+    db = db if db is not None else get_mongo_db()
+    games = load_games(db)
+    clusters = cluster_games(games)
+    now = datetime.now(timezone.utc)
+
+    by_key = {}
+    for members in clusters:
+        link = link_document(games, members, now)
+        by_key.setdefault(link["key"], []).append(link)
+    docs = {}
+    for links in by_key.values():
+        for link in links:
+            if len(links) > 1:
+                # Distinct clusters with the same canonical title are told apart by their first member
+                first = min((m["service"], str(m["native_id"] or m["title"])) for m in link["members"])
+                link["_id"] = hashlib.sha1(f"{link['key']}:{first[0]}:{first[1]}".encode("utf-8")).hexdigest()[:16]
+            docs[link["_id"]] = link
+
+    # Scrapers finishing at the same time rebuild concurrently; each run
+    # builds its own tmp collection and the last rename wins
+    tmp_name = f"{LINKS_COLLECTION}_tmp_{uuid.uuid4().hex[:12]}"
+    tmp_coll = db[tmp_name]
+    try:
+        batch = []
+        for link in docs.values():
+            batch.append(link)
+            if len(batch) >= 1000:
+                tmp_coll.insert_many(batch, ordered=False)
+                batch = []
+        if batch:
+            tmp_coll.insert_many(batch, ordered=False)
+        tmp_coll.create_index([("members.service", 1), ("members.title", 1)])
+        tmp_coll.create_index([("members.service", 1), ("members.native_id", 1)])
+        tmp_coll.create_index("services")
+        db.client.admin.command(
+            "renameCollection",
+            f"{db.name}.{tmp_name}",
+            to=f"{db.name}.{LINKS_COLLECTION}",
+            dropTarget=True
+        )
+    except Exception:
+        tmp_coll.drop()
+        raise
+    linked = sum(1 for link in docs.values() if len(link["services"]) > 1)
+    log_info(f"Linked {len(games)} games into {len(docs)} entities ({linked} across stores)")
+
+if __name__ == "__main__":
+    link_games()
@@ -0,0 +1,190 @@
+import os
+import time
+import atexit
+import threading
+from urllib.parse import urlparse
+from pymongo import monitoring, UpdateOne
+from requests.exceptions import ProxyError, ConnectTimeout, SSLError
+
+# Counters and histograms are accumulated in-process and added to shared
+# documents in Mongo with $inc, so the API workers and every scraper process
+# contribute to the same series. /metrics renders them in the Prometheus
+# text format.
+METRICS_COLLECTION = "metrics"
+METRICS_FLUSH_INTERVAL = float(os.getenv("METRICS_FLUSH_INTERVAL", "10"))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_pending = {}
+_lock = threading.Lock()
+_last_flush = time.monotonic()
+_flushing = threading.local()
+
+def _reset_after_fork():
+    # Counts recorded by the parent are flushed by the parent
+    global _lock, _last_flush
+    _pending.clear()
+    _lock = threading.Lock()
+    _last_flush = time.monotonic()
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def series_id(name, labels):
+    if not labels:
+        return name
+    return name + "{" + ",".join(f"{k}={labels[k]}" for k in sorted(labels)) + "}"
+
+def _entry(kind, name, labels):
+    key = series_id(name, labels)
+    entry = _pending.get(key)
+    if entry is None:
+        entry = _pending[key] = {"type": kind, "name": name, "labels": dict(labels or {}), "inc": {}, "set": None}
+    return entry
+
+def inc_counter(name, labels=None, value=1, flush=True):
+    with _lock:
+        inc = _entry("counter", name, labels)["inc"]
+        inc["value"] = inc.get("value", 0) + value
+    if flush:
+        maybe_flush()
+
+def inc_gauge(name, value, labels=None):
+    with _lock:
+        inc = _entry("gauge", name, labels)["inc"]
+        inc["value"] = inc.get("value", 0) + value
+    maybe_flush()
+
+def set_gauge(name, value, labels=None):
+    with _lock:
+        entry = _entry("gauge", name, labels)
+        entry["inc"] = {}
+        entry["set"] = value
+    maybe_flush()
+
+def observe(name, value, labels=None, buckets=LATENCY_BUCKETS, flush=True):
+    index = next((i for i, bound in enumerate(buckets) if value <= bound), len(buckets))
+    with _lock:
+        entry = _entry("histogram", name, labels)
+        entry["buckets"] = buckets
+        inc = entry["inc"]
+        inc[f"buckets.{index}"] = inc.get(f"buckets.{index}", 0) + 1
+        inc["sum"] = inc.get("sum", 0) + value
+        inc["count"] = inc.get("count", 0) + 1
+    if flush:
+        maybe_flush()
+
+def maybe_flush():
+    if time.monotonic() - _last_flush >= METRICS_FLUSH_INTERVAL:
+        flush_metrics()
+
+def flush_metrics(db=None):
+    """Add this process's pending counts to the shared metric documents."""
+    global _last_flush
+    if getattr(_flushing, "active", False):
+        return
+    with _lock:
+        if not _pending:
+            _last_flush = time.monotonic()
+            return
+        pending = dict(_pending)
+        _pending.clear()
+        _last_flush = time.monotonic()
+
+    ops = []
+    for key, entry in pending.items():
+        update = {"$set": {"type": entry["type"], "name": entry["name"], "labels": entry["labels"]}}
+        if entry.get("buckets"):
+            update["$set"]["bounds"] = list(entry["buckets"])
+        if entry["set"] is not None:
+            update["$set"]["value"] = entry["set"] + entry["inc"].get("value", 0)
+        elif entry["inc"]:
+            update["$inc"] = entry["inc"]
+        ops.append(UpdateOne({"_id": key}, update, upsert=True))
+
+    _flushing.active = True
+    try:
+        if db is None:
+            from utils import get_mongo_db
+            db = get_mongo_db()
+        db[METRICS_COLLECTION].bulk_write(ops, ordered=False)
+    except Exception as e:
+        print(f"Error flushing metrics: {e}")
+    finally:
+        _flushing.active = False
+
+atexit.register(flush_metrics)
+
+class MongoCommandTimer(monitoring.CommandListener):
+    """Records the duration of every Mongo command by command name.
+    Never flushes itself, so no query is issued from inside a command."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        observe("mongo_command_duration_seconds", event.duration_micros / 1e6, {"command": event.command_name}, flush=False)
+
+    def failed(self, event):
+        observe("mongo_command_duration_seconds", event.duration_micros / 1e6, {"command": event.command_name}, flush=False)
+        inc_counter("mongo_command_failures_total", {"command": event.command_name}, flush=False)
+
+def proxy_label(proxy):
+    parsed = urlparse(proxy if "://" in proxy else f"http://{proxy}")
+    return f"{parsed.hostname}:{parsed.port}" if parsed.port else str(parsed.hostname)
+
+def instrument_session(session):
+    """Count upstream requests, errors and proxy failures made through a requests session."""
+    send = session.request
+
+    def request(method, url, *args, **kwargs):
+        host = urlparse(url).hostname or "unknown"
+        try:
+            response = send(method, url, *args, **kwargs)
+        except Exception as e:
+            inc_counter("upstream_errors_total", {"host": host, "error": type(e).__name__})
+            proxy = (session.proxies or {}).get("https")
+            if proxy and isinstance(e, (ProxyError, ConnectTimeout, SSLError)):
+                inc_counter("proxy_failures_total", {"proxy": proxy_label(proxy)})
+            raise
+        inc_counter("upstream_requests_total", {"host": host, "status": f"{response.status_code // 100}xx"})
+        return response
+
+    session.request = request
+    return session
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _labels_text(labels, extra=None):
+    items = list((labels or {}).items()) + list((extra or {}).items())
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+def render_metrics(docs, gauges=None):
+    """Prometheus text exposition of metric documents plus live gauges."""
+    by_name = {}
+    for doc in docs:
+        by_name.setdefault(doc["name"], []).append(doc)
+    for name, value, labels in gauges or []:
+        by_name.setdefault(name, []).append({"type": "gauge", "name": name, "labels": labels, "value": value})
+
+    lines = []
+    for name in sorted(by_name):
+        series = by_name[name]
+        lines.append(f"# TYPE {name} {series[0]['type']}")
+        for doc in series:
+            labels = doc.get("labels") or {}
+            if doc["type"] != "histogram":
+                lines.append(f"{name}{_labels_text(labels)} {doc.get('value', 0)}")
+                continue
+            counts = doc.get("buckets") or {}
+            bounds = doc.get("bounds") or []
+            cumulative = 0
+            for i, bound in enumerate(bounds):
+                cumulative += counts.get(str(i), 0)
+                lines.append(f"{name}_bucket{_labels_text(labels, {'le': bound})} {cumulative}")
+            lines.append(f"{name}_bucket{_labels_text(labels, {'le': '+Inf'})} {doc.get('count', 0)}")
+            lines.append(f"{name}_sum{_labels_text(labels)} {doc.get('sum', 0)}")
+            lines.append(f"{name}_count{_labels_text(labels)} {doc.get('count', 0)}")
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,193 @@
+import os
+import heapq
+import math
+import random
+from datetime import datetime, timedelta, timezone
+from pymongo import UpdateOne
+from utils import log_info, ensure_game_indexes, PRICE_HISTORY_COLLECTION
+
+# /game request counts per title, used to favour games people look at
+REQUESTS_COLLECTION = "game_requests"
+# Summary of the last refresh plan per service
+PLANS_COLLECTION = "refresh_plans"
+# Last time a listed game that has no stored document was planned; ids
+# without a store page or with failing fetches would otherwise always win
+ATTEMPTS_COLLECTION = "refresh_attempts"
+
+# Upstream requests a scheduled run may spend per service; 0 refreshes everything
+DEFAULT_REQUEST_BUDGETS = {"steam": 400000, "nintendo": 100000, "xbox": 20000}
+
+# Games fall into tiers by volatility and popularity; a game is due once it
+# is older than its tier's max age.
+TIER_MAX_AGE = {
+    "hot": timedelta(hours=float(os.getenv("REFRESH_HOT_MAX_AGE_HOURS", "6"))),
+    "warm": timedelta(hours=float(os.getenv("REFRESH_WARM_MAX_AGE_HOURS", "24"))),
+    "cold": timedelta(hours=float(os.getenv("REFRESH_COLD_MAX_AGE_HOURS", "168"))),
+}
+HOT_PRICE_CHANGES = int(os.getenv("REFRESH_HOT_PRICE_CHANGES", "3"))
+HOT_REQUESTS = float(os.getenv("REFRESH_HOT_REQUESTS", "5"))
+PRICE_CHANGE_WINDOW_DAYS = int(os.getenv("REFRESH_PRICE_CHANGE_WINDOW_DAYS", "30"))
+REQUEST_HALF_LIFE_DAYS = float(os.getenv("REFRESH_REQUEST_HALF_LIFE_DAYS", "7"))
+
+def request_budget(service):
+    return int(os.getenv(f"{service.upper()}_REFRESH_REQUEST_BUDGET", DEFAULT_REQUEST_BUDGETS.get(service, 0)))
+
+def record_game_request(db, service, title):
+    db[REQUESTS_COLLECTION].update_one(
+        {"_id": f"{service}:{title}"},
+        {
+            "$inc": {"count": 1},
+            "$set": {"service": service, "title": title, "last_requested_at": datetime.now(timezone.utc)}
+        },
+        upsert=True
+    )
+
+def load_request_counts(db, service, now):
+    """title -> request count, halved for every REQUEST_HALF_LIFE_DAYS since the last request."""
+    counts = {}
+    for doc in db[REQUESTS_COLLECTION].find({"service": service}, {"title": 1, "count": 1, "last_requested_at": 1}):
+        last = doc.get("last_requested_at")
+        if last and last.tzinfo is None:
+            last = last.replace(tzinfo=timezone.utc)
+        days = (now - last).total_seconds() / 86400 if last else 0
+        counts[doc["title"]] = doc.get("count", 0) * 0.5 ** (days / REQUEST_HALF_LIFE_DAYS)
+    return counts
+
+def load_price_changes(db, service, now):
+    """native_id -> number of refreshes with a price change in the window."""
+    changes = {}
+    pipeline = [
+        {"$match": {"meta.store": service, "ts": {"$gte": now - timedelta(days=PRICE_CHANGE_WINDOW_DAYS)}}},
+        {"$group": {"_id": {"native_id": "$meta.native_id", "ts": "$ts"}}},
+        {"$group": {"_id": "$_id.native_id", "changes": {"$sum": 1}}},
+    ]
+    for row in db[PRICE_HISTORY_COLLECTION].aggregate(pipeline, allowDiskUse=True):
+        changes[row["_id"]] = row["changes"]
+    return changes
+
+def game_tier(price_changes, requests):
+    if price_changes >= HOT_PRICE_CHANGES or requests >= HOT_REQUESTS:
+        return "hot"
+    if price_changes or requests >= 1:
+        return "warm"
+    return "cold"
+
+def priority_score(tier, fetched_at, requests, now):
+    """How overdue a game is for its tier; never-fetched games come first."""
+    if fetched_at is None:
+        return math.inf
+    if fetched_at.tzinfo is None:
+        fetched_at = fetched_at.replace(tzinfo=timezone.utc)
+    overdue = (now - fetched_at) / TIER_MAX_AGE[tier]
+    return overdue + 0.01 * math.log1p(requests)
+
+def plan_refresh(db, collection_name, items, native_id_of, requests_per_item=1):
+    """
+    Pick the listed items to refresh this run, highest priority first, within
+    the service's request budget. Skipped games that are already stored get a
+    marker in the tmp snapshot so the swap keeps them listed.
+    """
+    service = collection_name.replace("_games", "")
+    budget = request_budget(service)
+    live = db[collection_name]
+    if not budget or live.estimated_document_count() == 0:
+        save_plan(db, service, {"request_budget": budget, "listed": len(items), "selected": len(items), "skipped": 0})
+        return items
+    # Games stored before native ids and fetch times were recorded can't be
+    # matched to the listing; refresh everything until a full run rewrote them
+    if live.find_one({"$or": [{"native_id": {"$exists": False}}, {"fetched_at": {"$exists": False}}]}, {"_id": 1}):
+        log_info(f"{service}: stored games without native_id or fetched_at, refreshing all {len(items)} listed games")
+        save_plan(db, service, {"request_budget": budget, "listed": len(items), "selected": len(items), "skipped": 0})
+        return items
+
+    now = datetime.now(timezone.utc)
+    stored = {
+        doc.get("native_id"): doc
+        for doc in live.find({}, {"_id": 0, "native_id": 1, "title": 1, "fetched_at": 1}).batch_size(10000)
+    }
+    requests = load_request_counts(db, service, now)
+    changes = load_price_changes(db, service, now)
+    attempts = load_attempts(db, service)
+
+    tiers = {"hot": 0, "warm": 0, "cold": 0, "new": 0}
+    # Ties (e.g. between never-tried games) are broken randomly, not by listing position
+    scored = []
+    for i, item in enumerate(items):
+        native_id = native_id_of(item)
+        doc = stored.get(native_id)
+        if doc is None:
+            tiers["new"] += 1
+            # Never tried first; tried but still not stored waits like a cold game
+            scored.append((priority_score("cold", attempts.get(native_id), 0, now), random.random(), i))
+            continue
+        item_requests = requests.get(doc.get("title"), 0)
+        tier = game_tier(changes.get(native_id, 0), item_requests)
+        tiers[tier] += 1
+        scored.append((priority_score(tier, doc.get("fetched_at"), item_requests, now), random.random(), i))
+
+    limit = max(1, budget // max(1, requests_per_item))
+    selected = heapq.nlargest(limit, scored)
+    selected_ids = {i for _, _, i in selected}
+    record_attempts(db, service, [
+        native_id_of(items[i]) for i in selected_ids if native_id_of(items[i]) not in stored
+    ], now)
+
+    skipped_titles = []
+    for i, item in enumerate(items):
+        if i in selected_ids:
+            continue
+        doc = stored.get(native_id_of(item))
+        if doc and doc.get("title"):
+            skipped_titles.append(doc["title"])
+    mark_skipped(db, collection_name, skipped_titles)
+
+    save_plan(db, service, {
+        "request_budget": budget,
+        "listed": len(items),
+        "selected": len(selected),
+        "skipped": len(skipped_titles),
+        "tiers": tiers,
+    })
+    log_info(f"{service}: refreshing {len(selected)} of {len(items)} listed games within a budget of {budget} requests (tiers: {tiers})")
+    return [items[i] for _, _, i in selected]
+
+def load_attempts(db, service):
+    """native_id -> last time a not yet stored game was planned."""
+    return {
+        doc["native_id"]: doc["attempted_at"]
+        for doc in db[ATTEMPTS_COLLECTION].find({"service": service}, {"_id": 0, "native_id": 1, "attempted_at": 1})
+    }
+
+def record_attempts(db, service, native_ids, now):
+    for i in range(0, len(native_ids), 1000):
+        db[ATTEMPTS_COLLECTION].bulk_write([
+            UpdateOne(
+                {"_id": f"{service}:{native_id}"},
+                {"$set": {"service": service, "native_id": native_id, "attempted_at": now}},
+                upsert=True
+            )
+            for native_id in native_ids[i:i + 1000]
+        ], ordered=False)
+
+def save_plan(db, service, plan):
+    """Store the plan; a partial plan keeps update_mongo from renaming the tmp snapshot over the live one."""
+    plan["partial"] = plan["selected"] < plan["listed"]
+    db[PLANS_COLLECTION].replace_one({"_id": service}, {"planned_at": datetime.now(timezone.utc), **plan}, upsert=True)
+
+def plan_is_partial(db, collection_name):
+    plan = db[PLANS_COLLECTION].find_one({"_id": collection_name.replace("_games", "")}, {"partial": 1})
+    return bool(plan and plan.get("partial"))
+
+def mark_skipped(db, collection_name, titles):
+    """Keep stored games that were not refreshed listed in the tmp snapshot."""
+    tmp_coll = db[f"{collection_name}_tmp"]
+    ensure_game_indexes(tmp_coll)
+    for i in range(0, len(titles), 1000):
+        tmp_coll.bulk_write([
+            UpdateOne(
+                {"title": title},
+                {"$setOnInsert": {"title": title, "unchanged": True, "skipped": True}},
+                upsert=True
+            )
+            for title in titles[i:i + 1000]
+        ], ordered=False)
@@ -1,7 +1,12 @@
-import time, os, platform, subprocess, sys
-from utils import log_info
+import time, os, platform, subprocess, sys, signal, threading
+import psutil
+from datetime import datetime, timezone
+from multiprocessing.connection import Listener, Client
+from utils import log_info, get_mongo_db, get_proxies, MONGO_CONNECTION_BUDGET
+from metrics import METRICS_COLLECTION, series_id
 
-# Define the scraper order and their respective wait intervals (in seconds)
+# Define the scraper order (admission priority) and how long each one rests
+# between runs (in seconds)
 SCRAPER_ORDER = [
     ("scraper_nintendo.py", 10),
     ("scraper_playstation.py", 10),
@@ -9,41 +14,385 @@ SCRAPER_ORDER = [
     ("scraper_steam.py", 10),
 ]
 
-def run_scraper(scraper, interval):
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Scrapers run concurrently, each within a declared budget: worker processes,
+# memory of its whole process tree (MB) and share of proxies.txt. Override
+# with e.g. STEAM_MAX_PROCESSES, STEAM_MEMORY_MB and STEAM_PROXY_SHARE.
+DEFAULT_BUDGETS = {
+    "scraper_nintendo.py": (50, 6144, 0.4),
+    "scraper_playstation.py": (1, 512, 0.1),
+    "scraper_xbox.py": (20, 8192, 0.0),
+    "scraper_steam.py": (100, 6144, 0.5),
+}
+
+# A queued scraper is admitted only while the host has room for its budget
+SCHEDULER_MAX_PROCESSES = int(os.getenv("SCHEDULER_MAX_PROCESSES", "200"))
+SCHEDULER_MAX_LOAD = float(os.getenv("SCHEDULER_MAX_LOAD", "0.9"))  # 1-minute load average per CPU
+MEMORY_HARD_LIMIT_FACTOR = float(os.getenv("SCHEDULER_MEMORY_HARD_LIMIT_FACTOR", "2"))
+TICK = 1
+
+def service_name(scraper):
+    return scraper.replace("scraper_", "").replace(".py", "")
+
+def load_budgets():
+    budgets = {}
+    for scraper, (processes, memory_mb, proxy_share) in DEFAULT_BUDGETS.items():
+        prefix = service_name(scraper).upper()
+        budgets[scraper] = {
+            "processes": int(os.getenv(f"{prefix}_MAX_PROCESSES", processes)),
+            "memory_mb": int(os.getenv(f"{prefix}_MEMORY_MB", memory_mb)),
+            "proxy_share": float(os.getenv(f"{prefix}_PROXY_SHARE", proxy_share)),
+        }
+    return budgets
+
+BUDGETS = load_budgets()
+
+# Only one scheduler may hold the pidfile lock. It also serves a local
+# control socket for status and stop requests from the API.
+PIDFILE = os.getenv("SCHEDULER_PIDFILE", os.path.join(BASE_DIR, "scheduler.pid"))
+CONTROL_ADDRESS = ("127.0.0.1", int(os.getenv("SCHEDULER_CONTROL_PORT", "6001")))
+CONTROL_AUTHKEY = os.getenv("SCHEDULER_AUTHKEY", os.getenv("STATIC_ACCESS_TOKEN", "land33")).encode()
+CONTROL_TIMEOUT = float(os.getenv("SCHEDULER_CONTROL_TIMEOUT", "2"))
+STOP_GRACE_PERIOD = int(os.getenv("SCHEDULER_STOP_GRACE_PERIOD", "10"))
+PROGRESS_INTERVAL = int(os.getenv("SCHEDULER_PROGRESS_INTERVAL", "5"))
+
+stop_event = threading.Event()
+listener_closed = threading.Event()
+# Set by the SIGTERM handler; the tick loop turns it into a stop, since the
+# handler may interrupt the main thread while it holds state_lock
+term_requested = threading.Event()
+state = {
+    "pid": os.getpid(),
+    "started_at": None,
+    "stopping": False,
+    "scrapers": {
+        scraper: {
+            "status": "queued",
+            "runs": 0,
+            "pid": None,
+            "started_at": None,
+            "finished_at": None,
+            "returncode": None,
+            "rss_mb": 0,
+            "queue_depth": None,
+            "blocked_by": None,
+            "budget": BUDGETS[scraper],
+        }
+        for scraper, _ in SCRAPER_ORDER
+    },
+}
+state_lock = threading.Lock()
+running = {}  # scraper -> Popen
+
+def _lock_file(f):
+    if platform.system() == "Windows":
+        import msvcrt
+        msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+def _unlock_file(f):
+    if platform.system() == "Windows":
+        import msvcrt
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+def acquire_pidfile():
+    """Lock the pidfile and write our pid; returns the open file or None if another scheduler holds it."""
+    f = open(PIDFILE, "a+")
+    try:
+        _lock_file(f)
+    except OSError:
+        f.close()
+        return None
+    f.seek(0)
+    f.truncate()
+    f.write(str(os.getpid()))
+    f.flush()
+    return f
+
+def scheduler_locked():
+    """True while a scheduler process holds the pidfile lock."""
+    if not os.path.exists(PIDFILE):
+        return False
+    with open(PIDFILE, "a+") as f:
+        try:
+            _lock_file(f)
+        except OSError:
+            return True
+        _unlock_file(f)
+    return False
+
+def scheduler_request(command: dict, timeout: float = CONTROL_TIMEOUT):
+    """Send a command to the running scheduler; None if none is listening."""
+    try:
+        conn = Client(CONTROL_ADDRESS, authkey=CONTROL_AUTHKEY)
+    except OSError:
+        return None
     try:
-        log_info(f"========== Starting {scraper}... ==========")
-        python_exec = sys.executable
-        script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), scraper)
+        conn.send(command)
+        if not conn.poll(timeout):
+            return None
+        return conn.recv()
+    except (OSError, EOFError):
+        return None
+    finally:
+        conn.close()
 
+def terminate_scraper(proc):
+    """SIGTERM the scraper's process group, SIGKILL it after the grace period."""
+    if proc is None or proc.poll() is not None:
+        return
+    try:
+        if platform.system() == "Windows":
+            proc.send_signal(signal.CTRL_BREAK_EVENT)
+        else:
+            os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=STOP_GRACE_PERIOD)
+    except subprocess.TimeoutExpired:
         if platform.system() == "Windows":
-            # On Windows, use CREATE_NEW_PROCESS_GROUP
-            proc = subprocess.Popen(
-                [python_exec, script_path],
-                creationflags=subprocess.CREATE_NEW_PROCESS_GROUP
-            )
+            proc.kill()
         else:
-            # On Unix-based systems, use os.setsid()
-            proc = subprocess.Popen(
-                [python_exec, script_path],  # Use "python3" for Unix-based systems
-                preexec_fn=os.setsid
-            )
+            os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, OSError):
+        pass
 
-        log_info(f"Process {scraper} started with PID {proc.pid}")
+def request_stop(after_current=False):
+    with state_lock:
+        state["stopping"] = "after_current" if after_current else True
+        procs = list(running.values())
+    stop_event.set()
+    if not after_current:
+        log_info("Scheduler: stop requested, terminating running scrapers")
+        for proc in procs:
+            threading.Thread(target=terminate_scraper, args=(proc,), daemon=True).start()
+    else:
+        log_info("Scheduler: stop requested after the running scrapers finish")
 
-        proc.wait()
+def status():
+    with state_lock:
+        snapshot = dict(state)
+        snapshot["scrapers"] = {name: dict(info) for name, info in state["scrapers"].items()}
+    snapshot["running"] = True
+    return snapshot
 
-        log_info(f"========== Finished {scraper} and Updated db. ==========")
+def handle_command(command):
+    cmd = (command or {}).get("cmd")
+    if cmd == "status":
+        return status()
+    if cmd == "stop":
+        request_stop(after_current=bool(command.get("after_current")))
+        return {"msg": "stopping", **status()}
+    return {"error": f"Unknown command {cmd}"}
+
+def serve_control(listener):
+    while not listener_closed.is_set():
+        try:
+            conn = listener.accept()
+        except Exception:
+            if listener_closed.is_set():
+                return
+            continue
+        try:
+            if conn.poll(CONTROL_TIMEOUT):
+                conn.send(handle_command(conn.recv()))
+        except Exception as e:
+            print(f"Scheduler.py : Error handling control request: {e}")
+        finally:
+            conn.close()
+
+def tree_rss_mb(proc):
+    """Resident memory of a scraper and all of its children (workers, Chrome)."""
+    try:
+        parent = psutil.Process(proc.pid)
+        procs = [parent] + parent.children(recursive=True)
+    except psutil.NoSuchProcess:
+        return 0
+    total = 0
+    for p in procs:
+        try:
+            total += p.memory_info().rss
+        except psutil.NoSuchProcess:
+            pass
+    return round(total / (1024 * 1024))
+
+def poll_progress():
+    """Copy memory use and queue depth of running scrapers into the state, so status stays a dict lookup."""
+    while not listener_closed.wait(PROGRESS_INTERVAL):
+        with state_lock:
+            procs = dict(running)
+        for scraper, proc in procs.items():
+            rss_mb = tree_rss_mb(proc)
+            try:
+                doc = get_mongo_db()[METRICS_COLLECTION].find_one(
+                    {"_id": series_id("scraper_queue_depth", {"service": service_name(scraper)})}, {"value": 1}
+                )
+                queue_depth = doc.get("value") if doc else None
+            except Exception as e:
+                print(f"Scheduler.py : Error reading progress: {e}")
+                queue_depth = None
+            with state_lock:
+                state["scrapers"][scraper]["rss_mb"] = rss_mb
+                state["scrapers"][scraper]["queue_depth"] = queue_depth
+
+def proxy_slices():
+    """Disjoint slices of proxies.txt sized by each scraper's proxy share."""
+    count = len(get_proxies())
+    total_share = sum(budget["proxy_share"] for budget in BUDGETS.values()) or 1
+    slices, start = {}, 0
+    for scraper, _ in SCRAPER_ORDER:
+        share = BUDGETS[scraper]["proxy_share"]
+        size = max(1, int(count * share / total_share)) if share > 0 and count else 0
+        end = min(start + size, count)
+        slices[scraper] = f"{start}:{end}"
+        start = end
+    return slices
+
+def scraper_env(scraper):
+    budget = BUDGETS[scraper]
+    total_processes = sum(b["processes"] for b in BUDGETS.values())
+    env = dict(os.environ)
+    env["SCRAPER_PROCESSES"] = str(budget["processes"])
+    env["SCRAPER_PROXY_SLICE"] = proxy_slices()[scraper]
+    # Concurrent scrapers split the Mongo connection budget by their process share
+    env["MONGO_CONNECTION_BUDGET"] = str(max(1, MONGO_CONNECTION_BUDGET * budget["processes"] // total_processes))
+    return env
 
-    except Exception as e:
-        print(f"Scheduler.py : Error running {scraper}: {e}")
-        time.sleep(60)  # Wait before retrying in case of an error
+def admission_block(scraper):
+    """Why the scraper can't start now given live host load, or None if it can."""
+    if not running:
+        return None
+    budget = BUDGETS[scraper]
+    if sum(BUDGETS[s]["processes"] for s in running) + budget["processes"] > SCHEDULER_MAX_PROCESSES:
+        return "process limit"
+    load = psutil.getloadavg()[0] / (psutil.cpu_count() or 1)
+    if load > SCHEDULER_MAX_LOAD:
+        return f"host load {load:.2f}"
+    # Memory not yet used by running scrapers is still reserved for them
+    available_mb = psutil.virtual_memory().available / (1024 * 1024)
+    reserved_mb = sum(max(0, BUDGETS[s]["memory_mb"] - state["scrapers"][s]["rss_mb"]) for s in running)
+    if available_mb - reserved_mb < budget["memory_mb"]:
+        return f"memory ({available_mb - reserved_mb:.0f} MB free)"
+    return None
 
-    time.sleep(interval)
+def start_scraper(scraper):
+    log_info(f"========== Starting {scraper}... ==========")
+    python_exec = sys.executable
+    script_path = os.path.join(BASE_DIR, scraper)
+
+    if platform.system() == "Windows":
+        # On Windows, use CREATE_NEW_PROCESS_GROUP
+        proc = subprocess.Popen(
+            [python_exec, script_path],
+            env=scraper_env(scraper),
+            creationflags=subprocess.CREATE_NEW_PROCESS_GROUP
+        )
+    else:
+        # On Unix-based systems, use os.setsid()
+        proc = subprocess.Popen(
+            [python_exec, script_path],  # Use "python3" for Unix-based systems
+            env=scraper_env(scraper),
+            preexec_fn=os.setsid
+        )
+
+    with state_lock:
+        running[scraper] = proc
+        info = state["scrapers"][scraper]
+        info.update({
+            "status": "running",
+            "pid": proc.pid,
+            "started_at": datetime.now(timezone.utc).isoformat(),
+            "rss_mb": 0,
+            "queue_depth": None,
+            "blocked_by": None,
+        })
+        info["runs"] += 1
+    log_info(f"Process {scraper} started with PID {proc.pid}")
+    if state["stopping"] is True:
+        # Stop arrived while the scraper was being started
+        terminate_scraper(proc)
+    return proc
+
+def reap_scrapers(due, intervals):
+    for scraper, proc in list(running.items()):
+        if proc.poll() is None:
+            continue
+        with state_lock:
+            del running[scraper]
+            state["scrapers"][scraper].update({
+                "status": "waiting",
+                "pid": None,
+                "finished_at": datetime.now(timezone.utc).isoformat(),
+                "returncode": proc.returncode,
+            })
+        due[scraper] = time.monotonic() + intervals[scraper]
+        log_info(f"========== Finished {scraper} and Updated db. ==========")
+
+def enforce_memory():
+    """Terminate a scraper whose process tree exceeds its memory budget by the hard limit factor."""
+    for scraper, proc in list(running.items()):
+        rss_mb = state["scrapers"][scraper]["rss_mb"]
+        if rss_mb > BUDGETS[scraper]["memory_mb"] * MEMORY_HARD_LIMIT_FACTOR:
+            log_info(f"Scheduler: {scraper} uses {rss_mb} MB, over its budget, terminating")
+            threading.Thread(target=terminate_scraper, args=(proc,), daemon=True).start()
 
 def main():
-    while True:        
-        for scraper, interval in SCRAPER_ORDER:
-            run_scraper(scraper, interval)
+    pidfile = acquire_pidfile()
+    if pidfile is None:
+        log_info("Scheduler: another scheduler is already running")
+        sys.exit(1)
+
+    listener = Listener(CONTROL_ADDRESS, authkey=CONTROL_AUTHKEY)
+    threading.Thread(target=serve_control, args=(listener,), daemon=True).start()
+    threading.Thread(target=poll_progress, daemon=True).start()
+    if platform.system() != "Windows":
+        signal.signal(signal.SIGTERM, lambda signum, frame: term_requested.set())
+    state["started_at"] = datetime.now(timezone.utc).isoformat()
+
+    intervals = dict(SCRAPER_ORDER)
+    due = {scraper: time.monotonic() for scraper in intervals}
+    try:
+        while True:
+            if term_requested.is_set():
+                term_requested.clear()
+                request_stop()
+            reap_scrapers(due, intervals)
+            if stop_event.is_set():
+                if not running:
+                    break
+                time.sleep(TICK)
+                continue
+            enforce_memory()
+            for scraper, _ in SCRAPER_ORDER:
+                if scraper in running or time.monotonic() < due[scraper]:
+                    continue
+                blocked_by = admission_block(scraper)
+                with state_lock:
+                    state["scrapers"][scraper]["status"] = "queued"
+                    state["scrapers"][scraper]["blocked_by"] = blocked_by
+                if blocked_by:
+                    continue
+                try:
+                    start_scraper(scraper)
+                except Exception as e:
+                    print(f"Scheduler.py : Error running {scraper}: {e}")
+                    due[scraper] = time.monotonic() + 60  # Wait before retrying in case of an error
+            stop_event.wait(TICK)
+    finally:
+        for proc in list(running.values()):
+            terminate_scraper(proc)
+        listener_closed.set()
+        listener.close()
+        try:
+            os.remove(PIDFILE)
+        except OSError:
+            pass
+        pidfile.close()
+        log_info("Scheduler stopped")
 
 if __name__ == "__main__":
     main()
@@ -11,19 +11,17 @@ from datetime import datetime
 from bs4 import BeautifulSoup, Tag
 from requests.adapters import HTTPAdapter
 from concurrent.futures import ThreadPoolExecutor
-from utils import log_info, get_mongo_db, save_to_mongo, update_mongo, regions_nintendo, create_session
+from utils import log_info, get_mongo_db, save_to_mongo, update_mongo, regions_nintendo, create_session, configure_mongo_pool, load_content_hashes, get_proxies, split_proxies, log_mongo_pool_stats
+from metrics import set_gauge, inc_gauge, flush_metrics
+from checkpoint import begin_crawl, plan_crawl, remaining_items, record_done, crawl_complete, finish_crawl
 
-n_processes = 50
+n_processes = int(os.getenv("SCRAPER_PROCESSES", "50"))  # Set by the scheduler from the scraper's budget
 
-API_URL = "https://searching.nintendo-europe.com/en/select"
+# title -> content_hash of the live snapshot. main() loads it before the
+# workers fork, so they inherit it instead of receiving a copy per task.
+known_hashes = None
 
-# Load proxies from file (compute path relative to this script)
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-with open(os.path.join(BASE_DIR, "proxies.txt"), "r") as f:
-    PROXIES = [line.strip() for line in f if line.strip()]
-    
-chunk_size = (len(PROXIES) + n_processes - 1) // n_processes
-proxy_chunks = [PROXIES[i * chunk_size:(i + 1) * chunk_size] for i in range(n_processes)]
+API_URL = "https://searching.nintendo-europe.com/en/select"
 
 def fetch_games():
     from requests.exceptions import Timeout, RequestException
@@ -52,7 +50,8 @@ def fetch_games():
 def fetch_nintendo_game_by_title(title: str) -> dict | None:
     from requests.exceptions import Timeout, RequestException
     try:
-        proxy = choice(PROXIES)
+        proxies = get_proxies()
+        proxy = choice(proxies) if proxies else None
         session = create_session(proxy)
         params = {
             "q": title,
@@ -265,6 +264,10 @@ def fetch_prices(nsuid: str, slug: str | None, build_id: str, proxy) -> dict:
         
     return prices
 
+def native_id_of(game: dict) -> str:
+    nsuid = game.get('nsuid_txt', None)
+    return str(game.get('fs_id') or (nsuid[0] if nsuid else game.get('title', 'N/A')))
+
 def process_nintendo_game(game: dict, proxy) -> dict | None: 
     try:
         title = game.get('title', 'N/A')
@@ -303,7 +306,8 @@ def process_nintendo_game(game: dict, proxy) -> dict | None:
                 prices[region.split('-')[-1]] = 'N/A'
         
         game_data = {
-            "title": title,                          
+            "title": title,
+            "native_id": native_id_of(game),
             "categories": categories,
             "short_description": short_description,
             "full_description": full_description,
@@ -322,7 +326,7 @@ def process_nintendo_game(game: dict, proxy) -> dict | None:
         print(f"Error processing Nintendo game: {e}")
         return None
 
-def process_games_range(start_index, end_index, games, proxy_list):
+def process_games_range(start_index, end_index, games, proxy_list, run_id=None):
     db = get_mongo_db()
     
     for index in range(start_index, end_index):
@@ -331,13 +335,22 @@ def process_games_range(start_index, end_index, games, proxy_list):
         try:
             game_data = process_nintendo_game(games[index], proxy)
             if game_data:
-                save_to_mongo(db, "nintendo_games", game_data)
+                save_to_mongo(db, "nintendo_games", game_data, known_hashes)
             else:
                 print(f"Missing data for game {index}")
         except Exception as e:
             print(f"Error processing game at index {index}: {e}")
+        finally:
+            inc_gauge("scraper_queue_depth", -1, {"service": "nintendo"})
+            if run_id:
+                record_done(db, run_id, native_id_of(games[index]))
+    flush_metrics(db)
+    log_mongo_pool_stats()
 
 def main():
+    global known_hashes
+    # The parent keeps a client of its own next to the workers
+    configure_mongo_pool(n_processes + 1)
     log_info("Waiting for fetching Nintendo games...")
     games = fetch_games()
 
@@ -347,14 +360,29 @@ def main():
         return
     
     log_info(f"Fetched {total_games} games in Nintendo.")
+    db = get_mongo_db()
+    run_id, done = begin_crawl(db, "nintendo_games")
+    # Per game: page, description, slug, build id and one price request per region
+    games = plan_crawl(db, run_id, "nintendo_games", games, native_id_of, requests_per_item=4 + len(regions_nintendo))
+    games = remaining_items(db, run_id, done, games, native_id_of)
+
+    total_games = len(games)
     chunk_size = (total_games + n_processes - 1) // n_processes
     ranges = [(i * chunk_size, min((i + 1) * chunk_size, total_games)) for i in range(n_processes)]
-    
+
+    known_hashes = load_content_hashes(db, "nintendo_games")
+    set_gauge("scraper_queue_depth", total_games, {"service": "nintendo"})
+    flush_metrics(db)
+
+    proxy_chunks = split_proxies(n_processes)
     with multiprocessing.Pool(processes=n_processes) as pool:
-        pool.starmap(process_games_range, [(start, end, games, proxy_chunks[i]) for i, (start, end) in enumerate(ranges)])
+        pool.starmap(process_games_range, [(start, end, games, proxy_chunks[i], run_id) for i, (start, end) in enumerate(ranges)])
 
-    db = get_mongo_db()
+    if not crawl_complete(db, run_id):
+        log_info(f"Nintendo crawl {run_id} is incomplete; keeping the tmp snapshot for the next run.")
+        return
     update_mongo(db, "nintendo_games")
+    finish_crawl(db, run_id)
     log_info("All Nintendo processes completed.")
 
 if __name__ == "__main__":
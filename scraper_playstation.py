@@ -1,8 +1,8 @@
-import os
 import json
 import requests
 from random import choice
-from utils import log_info, save_to_mongo, get_mongo_db, update_mongo, create_session
+from utils import log_info, save_to_mongo, get_mongo_db, update_mongo, create_session, load_content_hashes, get_proxies, log_mongo_pool_stats
+from metrics import set_gauge, inc_gauge, flush_metrics
 
 GRAPHQL_URL = "https://web.np.playstation.com/api/graphql/v1"
 # Persisted query for fetching games list (categoryGridRetrieve)
@@ -26,14 +26,6 @@ CATEGORY_QUERY_TEMPLATE = {
 n_processes = 200  # Adjust based on your system's performance
 PLAYSTATION_URL = "https://store.playstation.com/en-us/pages/browse/1"
 
-# Load proxies from file
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-with open(os.path.join(BASE_DIR, "proxies.txt"), "r") as f:
-    PROXIES = [line.strip() for line in f if line.strip()]
-
-chunk_size = (len(PROXIES) + n_processes - 1) // n_processes
-proxy_chunks = [PROXIES[i * chunk_size:(i + 1) * chunk_size] for i in range(n_processes)]
-
 # Optional: persisted query template for fetching *single* product details.
 PRODUCT_QUERY_TEMPLATE = {
     "operationName": "productRetrieve",
@@ -56,7 +48,8 @@ def fetch_playstation_games(offset: int = 0, size: int = 24) -> list[dict]:
     payload["variables"]["pageArgs"] = {"size": size, "offset": offset}
 
     # pick random proxy if available
-    proxy = choice(PROXIES) if PROXIES else None
+    proxies = get_proxies()
+    proxy = choice(proxies) if proxies else None
     session = create_session(proxy)
 
     # send POST request to JSON endpoint
@@ -67,6 +60,17 @@ def fetch_playstation_games(offset: int = 0, size: int = 24) -> list[dict]:
     items = data["data"]["categoryGrid"]["products"]["items"]
     return items
 
+def to_game_document(item: dict) -> dict:
+    """
+    Add the fields shared by all stores (title, native_id, prices) to a raw GraphQL item.
+    """
+    price = item.get("price") or {}
+    game = dict(item)
+    game["title"] = item.get("name")
+    game["native_id"] = item.get("id") or item.get("productId")
+    game["prices"] = {"us": price.get("discountedPrice") or price.get("basePrice") or "N/A"}
+    return game
+
 def fetch_playstation_game_by_title(title: str, region: str = "en-us") -> dict | None:
     """
     Fetch a single game's full details by title via GraphQL persisted queries.
@@ -77,7 +81,7 @@ def fetch_playstation_game_by_title(title: str, region: str = "en-us") -> dict |
         
     # first, page through catalog to find matching title
     offset = 0
-    session = create_session(choice(PROXIES) if PROXIES else None)
+    session = create_session(choice(get_proxies()) if get_proxies() else None)
     while True:
         items = fetch_playstation_games(offset=offset, size=24)
         if not items:
@@ -88,9 +92,8 @@ def fetch_playstation_game_by_title(title: str, region: str = "en-us") -> dict |
                 product_query["variables"]["productId"] = item["productId"]
                 resp = session.post(GRAPHQL_URL, json=product_query, timeout=15)
                 resp.raise_for_status()
-                detail = resp.json()["data"]["product"]
+                detail = to_game_document(resp.json()["data"]["product"])
                 # save and return
-                db = get_mongo_db()
                 save_to_mongo(get_mongo_db(), "playstation_games", detail)
                 return detail
         offset += len(items)
@@ -105,13 +108,18 @@ def main():
         page = fetch_playstation_games(offset=offset, size=24)
         if not page:
             break
-        all_games.extend(page)
+        all_games.extend(to_game_document(item) for item in page)
         offset += len(page)
     log_info(f"Fetched total {len(all_games)} games.")
     # save to Mongo in bulk (upsert)
     db = get_mongo_db()
+    known_hashes = load_content_hashes(db, "playstation_games")
+    set_gauge("scraper_queue_depth", len(all_games), {"service": "playstation"})
     for game in all_games:
-        save_to_mongo(db, "playstation_games", game)
+        save_to_mongo(db, "playstation_games", game, known_hashes)
+        inc_gauge("scraper_queue_depth", -1, {"service": "playstation"})
+    flush_metrics(db)
+    log_mongo_pool_stats()
     update_mongo(db, "playstation_games")
     log_info("All PlayStation games saved.")
 
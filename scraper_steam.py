@@ -3,19 +3,27 @@ import requests
 import os
 from random import choice
 from requests.adapters import HTTPAdapter
-from utils import save_to_mongo, get_mongo_db, update_mongo, log_info, regions_steam
+from utils import save_to_mongo, get_mongo_db, update_mongo, log_info, regions_steam, configure_mongo_pool, load_content_hashes, get_proxies, log_mongo_pool_stats
 from requests.exceptions import ProxyError, ConnectTimeout, RequestException
 import itertools
+from metrics import instrument_session, set_gauge, inc_gauge, flush_metrics
+from checkpoint import begin_crawl, plan_crawl, remaining_items, record_done, crawl_complete, finish_crawl
 
-n_processes = 100  # Define number of processes
+n_processes = int(os.getenv("SCRAPER_PROCESSES", "100"))  # Set by the scheduler from the scraper's budget
 STEAM_API_URL = "https://api.steampowered.com/ISteamApps/GetAppList/v2/"
 
-# Load proxies efficiently
-BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-PROXY_FILE = os.path.join(BASE_DIR, "proxies.txt")
-with open(PROXY_FILE, "r") as f:
-    PROXIES = [line.strip() for line in f if line.strip()]
-proxy_pool = itertools.cycle(PROXIES)  # Efficient round-robin proxy cycling
+# Round-robin proxy cycling, created on first use
+proxy_pool = None
+
+# title -> content_hash of the live snapshot. main() loads it before the
+# workers fork, so they inherit it instead of receiving a copy per task.
+known_hashes = None
+
+def next_proxy():
+    global proxy_pool
+    if proxy_pool is None:
+        proxy_pool = itertools.cycle(get_proxies() or [None])
+    return next(proxy_pool)
 
 # Set up a requests session with proxy
 def create_session(proxy):
@@ -26,7 +34,7 @@ def create_session(proxy):
 
     session.headers.update({"User-Agent": "Mozilla/5.0"})  # Add a user agent for better response handling
     session.mount('https://', HTTPAdapter(max_retries=3))  # Retry on failure
-    return session
+    return instrument_session(session)
 
 def fetch_steam_apps(session):
     try:
@@ -40,7 +48,8 @@ def fetch_steam_apps(session):
 def fetch_steam_game_by_title(title: str, region: str = "ru") -> dict | None:
    
     for use_proxy in (True, False):
-        proxy = choice(PROXIES) if use_proxy else None
+        proxies = get_proxies()
+        proxy = choice(proxies) if use_proxy and proxies else None
         session = create_session(proxy)
         try:
             resp = session.get(
@@ -100,6 +109,7 @@ def fetch_game_details(app_id, session, region: str = "ru"):
 
         return {
             "title": game_info.get("name", "N/A"),
+            "native_id": str(app_id),
             "categories": [c["description"] for c in game_info.get("categories", [])],
             "short_description": game_info.get("short_description", "N/A"),
             "full_description": game_info.get("detailed_description", "N/A"),
@@ -117,7 +127,7 @@ def fetch_game_details(app_id, session, region: str = "ru"):
 
 def fetch_price_for_region(app_id, region):
     base_url = "https://store.steampowered.com/api/appdetails"
-    proxy = next(proxy_pool)
+    proxy = next_proxy()
     session = create_session(proxy)
     try:
         response = session.get(base_url, params={"appids": app_id, "cc": region, "l": "ru"}, timeout=10)
@@ -131,7 +141,10 @@ def fetch_price_for_region(app_id, region):
         print(f"Error fetching price for {app_id} in {region}: {e}")
     return "Not Available"
 
-def process_apps_range(start_index, end_index, apps, proxy):
+def app_native_id(app):
+    return str(app["appid"])
+
+def process_apps_range(start_index, end_index, apps, proxy, run_id=None):
     session = create_session(proxy)
     db = get_mongo_db()
 
@@ -140,29 +153,50 @@ def process_apps_range(start_index, end_index, apps, proxy):
         try:
             game_data = fetch_game_details(app["appid"], session)
             if "error" not in game_data:
-                save_to_mongo(db, "steam_games", game_data)
+                save_to_mongo(db, "steam_games", game_data, known_hashes)
         except Exception as e:
             print(f"Error processing app {app['appid']}: {e}")
+        finally:
+            inc_gauge("scraper_queue_depth", -1, {"service": "steam"})
+            if run_id:
+                record_done(db, run_id, app_native_id(app))
+    flush_metrics(db)
+    log_mongo_pool_stats()
 
 def main():
-    proxy_list = list(itertools.islice(proxy_pool, n_processes))  # Get unique proxies for each process
+    global known_hashes
+    # The parent keeps a client of its own next to the workers
+    configure_mongo_pool(n_processes + 1)
+    proxy_list = [next_proxy() for _ in range(n_processes)]  # Get unique proxies for each process
 
     apps = fetch_steam_apps(create_session(proxy_list[0]))  # Initial fetch using a proxy
     if not apps:
         log_info("No Steam apps found to process.")
         return
 
+    log_info(f"Found {len(apps)} games in Steam")
+    db = get_mongo_db()
+    run_id, done = begin_crawl(db, "steam_games")
+    apps = plan_crawl(db, run_id, "steam_games", apps, app_native_id, requests_per_item=1 + len(regions_steam))
+    apps = remaining_items(db, run_id, done, apps, app_native_id)
+
     total_apps = len(apps)
-    log_info(f"Found {total_apps} games in Steam")
     chunk_size = (total_apps + n_processes - 1) // n_processes
     ranges = [(i * chunk_size, min((i + 1) * chunk_size, total_apps)) for i in range(n_processes)]
 
+    known_hashes = load_content_hashes(db, "steam_games")
+    set_gauge("scraper_queue_depth", total_apps, {"service": "steam"})
+    flush_metrics(db)
+
     # Use Pool to manage processes efficiently with proxies
     with multiprocessing.Pool(processes=n_processes) as pool:
-        pool.starmap(process_apps_range, [(start, end, apps, proxy_list[i]) for i, (start, end) in enumerate(ranges)])
+        pool.starmap(process_apps_range, [(start, end, apps, proxy_list[i], run_id) for i, (start, end) in enumerate(ranges)])
 
-    db = get_mongo_db()
+    if not crawl_complete(db, run_id):
+        log_info(f"Steam crawl {run_id} is incomplete; keeping the tmp snapshot for the next run.")
+        return
     update_mongo(db, "steam_games")
+    finish_crawl(db, run_id)
     log_info("All Steam processes completed.")
 
 if __name__ == "__main__":
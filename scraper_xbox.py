@@ -1,15 +1,22 @@
 from bs4 import BeautifulSoup
 from utils import (
     get_mongo_db, save_to_mongo, update_mongo, get_selenium_browser, log_info,
-    click_loadmore_btn, regions_xbox
+    click_loadmore_btn, regions_xbox, configure_mongo_pool, load_content_hashes, log_mongo_pool_stats
 )
+import os
 import multiprocessing
 import requests
 from requests.adapters import HTTPAdapter
+from metrics import instrument_session, set_gauge, inc_gauge, flush_metrics
+from checkpoint import begin_crawl, plan_crawl, remaining_items, record_done, crawl_complete, finish_crawl
 
-n_processes = 20
+n_processes = int(os.getenv("SCRAPER_PROCESSES", "20"))  # Set by the scheduler from the scraper's budget
 XBOX_URL = "https://www.xbox.com/en-US/games/browse"
 
+# title -> content_hash of the live snapshot. main() loads it before the
+# workers fork, so they inherit it instead of receiving a copy per task.
+known_hashes = None
+
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64; rv:110.0) Gecko/20100101 Firefox/110.0",
     "Accept-Language": "en-US,en;q=0.9",
@@ -21,7 +28,7 @@ def create_session():
     session = requests.Session()
     session.headers.update(HEADERS)
     session.mount('https://', HTTPAdapter(max_retries=3))
-    return session
+    return instrument_session(session)
 
 def fetch_xbox_games():
     try:
@@ -80,6 +87,13 @@ def fetch_price_for_region(details_link, region):
     except requests.RequestException as e:
         return "BUNDLE NOT AVAILABLE"
 
+def native_id_from_link(details_link):
+    return details_link.rstrip('/').split('/')[-1].split('?')[0]
+
+def listing_native_id(game):
+    link = game.find('a', href=True)
+    return native_id_from_link(link['href']) if link else None
+
 def process_xbox_game(game):
     try:
         browser = get_selenium_browser()
@@ -105,6 +119,7 @@ def process_xbox_game(game):
         browser.quit()
         return {
             "title": title,
+            "native_id": native_id_from_link(details_link),
             "categories": categories,
             "short_description": short_description,
             "full_description": full_description,
@@ -122,18 +137,27 @@ def process_xbox_game(game):
         browser.quit()
         return None
 
-def process_games_range(start_index, end_index, games):
+def process_games_range(start_index, end_index, games, run_id=None):
     db = get_mongo_db()
 
     for index in range(start_index, end_index):
         try:
             game_data = process_xbox_game(games[index])
             if game_data:
-                save_to_mongo(db, "xbox_games", game_data)
+                save_to_mongo(db, "xbox_games", game_data, known_hashes)
         except Exception as e:
             print(f"Error processing Xbox game at index {index}: {e}")
+        finally:
+            inc_gauge("scraper_queue_depth", -1, {"service": "xbox"})
+            if run_id:
+                record_done(db, run_id, listing_native_id(games[index]))
+    flush_metrics(db)
+    log_mongo_pool_stats()
 
 def main():
+    global known_hashes
+    # The parent keeps a client of its own next to the workers
+    configure_mongo_pool(n_processes + 1)
     log_info("Waiting for fetching Xbox games...")
     games = fetch_xbox_games()
 
@@ -142,20 +166,33 @@ def main():
         log_info("No games found to process.")
         return
 
+    db = get_mongo_db()
+    run_id, done = begin_crawl(db, "xbox_games")
+    games = plan_crawl(db, run_id, "xbox_games", games, listing_native_id, requests_per_item=1 + len(regions_xbox))
+    games = remaining_items(db, run_id, done, games, listing_native_id)
+
+    total_games = len(games)
     chunk_size = (total_games + n_processes - 1) // n_processes
     ranges = [(i * chunk_size, min((i + 1) * chunk_size, total_games)) for i in range(n_processes)]
 
+    known_hashes = load_content_hashes(db, "xbox_games")
+    set_gauge("scraper_queue_depth", total_games, {"service": "xbox"})
+    flush_metrics(db)
+
     processes = []
     for start, end in ranges:
-        process = multiprocessing.Process(target=process_games_range, args=(start, end, games))
+        process = multiprocessing.Process(target=process_games_range, args=(start, end, games, run_id))
         processes.append(process)
         process.start()
 
     for process in processes:
         process.join()
 
-    db = get_mongo_db()
+    if not crawl_complete(db, run_id):
+        log_info(f"Xbox crawl {run_id} is incomplete; keeping the tmp snapshot for the next run.")
+        return
     update_mongo(db, "xbox_games")
+    finish_crawl(db, run_id)
     log_info("All Xbox processes completed.")
 
 if __name__ == "__main__":
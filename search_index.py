@@ -0,0 +1,102 @@
+import re
+import heapq
+import bisect
+import unicodedata
+from collections import Counter
+
+# Trigrams shared by more than this share of all titles carry almost no
+# signal and are only used when the query has nothing more selective.
+COMMON_TRIGRAM_RATIO = 0.05
+
+# Accents on Latin and Cyrillic letters; other marks (e.g. kana voicing) are kept
+ACCENTS = re.compile(r"[\u0300-\u036f]")
+
+def normalize_title(title: str) -> str:
+    """Casefold, strip accents, trademark signs and punctuation. Letters and
+    digits of every script are kept, so CJK and Cyrillic titles are searchable."""
+    title = re.sub(r"[\u2122\u00ae\u00a9\u2120]", "", title or "")
+    title = unicodedata.normalize("NFC", ACCENTS.sub("", unicodedata.normalize("NFKD", title)))
+    title = re.sub(r"[\W_]+", " ", title.casefold())
+    return title.strip()
+
+def trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+class TitleIndex:
+    """
+    In-process prefix and trigram index over the titles of all stores.
+
+    Prefix queries use a sorted list of normalized titles and words; fuzzy
+    and typo-tolerant queries rank candidates by trigram Jaccard similarity.
+    """
+
+    def __init__(self, games):
+        # games: iterable of (service, title, native_id)
+        self.entries = []
+        self.entry_trigrams = []
+        self.postings = {}
+        words = []
+        for service, title, native_id in games:
+            norm = normalize_title(title)
+            if not norm:
+                continue
+            entry_id = len(self.entries)
+            self.entries.append((service, title, native_id))
+            grams = trigrams(norm)
+            self.entry_trigrams.append(len(grams))
+            for gram in grams:
+                self.postings.setdefault(gram, []).append(entry_id)
+            for word in set(norm.split()):
+                words.append((word, entry_id))
+            words.append((norm, entry_id))
+        words.sort()
+        self.prefix_keys = [word for word, _ in words]
+        self.prefix_ids = [entry_id for _, entry_id in words]
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _prefix_matches(self, query, limit):
+        matches = []
+        start = bisect.bisect_left(self.prefix_keys, query)
+        for i in range(start, len(self.prefix_keys)):
+            if not self.prefix_keys[i].startswith(query) or len(matches) >= limit:
+                break
+            matches.append(self.prefix_ids[i])
+        return matches
+
+    def search(self, query: str, limit: int = 10, service: str | None = None) -> list[dict]:
+        norm = normalize_title(query)
+        if not norm:
+            return []
+
+        scores = Counter()
+        for entry_id in self._prefix_matches(norm, limit * 20):
+            scores[entry_id] = max(scores[entry_id], 0.5)
+
+        query_grams = trigrams(norm)
+        max_posting = max(1, int(len(self.entries) * COMMON_TRIGRAM_RATIO))
+        postings = [self.postings[g] for g in query_grams if g in self.postings]
+        selective = [p for p in postings if len(p) <= max_posting] or postings
+        shared = Counter()
+        for posting in selective:
+            shared.update(posting)
+        for entry_id, count in shared.items():
+            union = len(query_grams) + self.entry_trigrams[entry_id] - count
+            scores[entry_id] += count / union if union else 0
+
+        candidates = scores.items()
+        if service:
+            candidates = [item for item in candidates if self.entries[item[0]][0] == service]
+
+        results = []
+        for entry_id, score in heapq.nlargest(limit, candidates, key=lambda item: item[1]):
+            entry_service, title, native_id = self.entries[entry_id]
+            results.append({
+                "service": entry_service,
+                "title": title,
+                "native_id": native_id,
+                "score": round(score, 4)
+            })
+        return results
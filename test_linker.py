@@ -0,0 +1,68 @@
+from linker import canonical_title, publisher_tokens, release_year, cluster_games, is_match
+from search_index import trigrams
+
+def game(service, title, publisher=None, release_date=None, native_id=None):
+    key = canonical_title(title)
+    return {
+        "service": service,
+        "doc": {"title": title, "native_id": native_id or f"{service}-{title}"},
+        "key": key,
+        "grams": trigrams(key),
+        "publisher": publisher_tokens(publisher),
+        "year": release_year(release_date),
+    }
+
+def clusters_of(games):
+    return sorted(sorted(games[i]["doc"]["native_id"] for i in members) for members in cluster_games(games))
+
+def test_canonical_title_drops_store_and_platform_noise():
+    assert canonical_title("DOOM® Eternal - Xbox One") == "doom eternal"
+    assert canonical_title("Hollow Knight: Nintendo Switch Edition") == "hollow knight"
+    assert canonical_title("Celeste (PS4/PS5)") == "celeste"
+    assert canonical_title("Stardew Valley Standard Edition") == "stardew valley"
+
+def test_canonical_title_keeps_distinguishing_words():
+    assert canonical_title("Hades II") != canonical_title("Hades")
+    assert canonical_title("Portal 2") == "portal 2"
+
+def test_is_match_on_same_canonical_title():
+    assert is_match(game("steam", "Celeste"), game("xbox", "Celeste - Xbox One"))
+
+def test_is_match_needs_publisher_or_year_for_similar_titles():
+    a = game("steam", "The Witcher 3 Wild Hunt", "CD PROJEKT RED", "2015-05-18")
+    same_year = game("xbox", "Witcher 3 Wild Hunt", "Bandai Namco", "May 2015")
+    same_publisher = game("xbox", "Witcher 3 Wild Hunt", "CD Projekt Red Inc", "2016")
+    neither = game("xbox", "Witcher 3 Wild Hunt", "Bandai Namco", "2016")
+    assert is_match(a, same_year)
+    assert is_match(a, same_publisher)
+    assert not is_match(a, neither)
+
+def test_is_match_rejects_different_games():
+    assert not is_match(game("steam", "Hades"), game("xbox", "Halo Infinite"))
+
+def test_cluster_games_links_across_stores():
+    games = [
+        game("steam", "Celeste", native_id="s1"),
+        game("xbox", "Celeste - Xbox One", native_id="x1"),
+        game("nintendo", "Celeste Nintendo Switch", native_id="n1"),
+        game("steam", "Hades", native_id="s2"),
+    ]
+    assert clusters_of(games) == [["n1", "s1", "x1"], ["s2"]]
+
+def test_cluster_games_never_merges_the_same_store():
+    games = [
+        game("steam", "Celeste", native_id="s1"),
+        game("steam", "Celeste", native_id="s2"),
+    ]
+    assert clusters_of(games) == [["s1"], ["s2"]]
+
+def test_cluster_games_does_not_chain_two_games_of_one_store():
+    # Steam A ~ Xbox X ~ Steam B must not put A and B in one entity
+    games = [
+        game("steam", "Celeste", native_id="s1"),
+        game("xbox", "Celeste", native_id="x1"),
+        game("steam", "Celeste - PC", native_id="s2"),
+    ]
+    clusters = clusters_of(games)
+    assert ["s1", "s2", "x1"] not in clusters
+    assert sorted(sum(clusters, [])) == ["s1", "s2", "x1"]
@@ -0,0 +1,21 @@
+from search_index import normalize_title, TitleIndex
+
+def test_normalize_title_strips_accents_marks_and_punctuation():
+    assert normalize_title("Pokémon™ Scarlet") == "pokemon scarlet"
+    assert normalize_title("DOOM® Eternal: The Ancient Gods — Part One") == "doom eternal the ancient gods part one"
+    assert normalize_title("Straße_Racer") == "strasse racer"
+
+def test_normalize_title_keeps_non_latin_scripts():
+    assert normalize_title("Ведьмак 3: Дикая Охота") == "ведьмак 3 дикая охота"
+    assert normalize_title("ゼルダの伝説") == "ゼルダの伝説"
+    assert normalize_title("原神") == "原神"
+
+def test_search_finds_cyrillic_and_cjk_titles():
+    index = TitleIndex([
+        ("steam", "Ведьмак 3: Дикая Охота", "292030"),
+        ("nintendo", "ゼルダの伝説 ティアーズ オブ ザ キングダム", "70010000063714"),
+        ("steam", "Pokémon Scarlet", "1"),
+    ])
+    assert index.search("ведьмак")[0]["native_id"] == "292030"
+    assert index.search("ゼルダ")[0]["native_id"] == "70010000063714"
+    assert index.search("pokemon")[0]["native_id"] == "1"
@@ -0,0 +1,16 @@
+from utils import parse_price
+
+def test_parse_price_reads_prefixed_dollars():
+    assert parse_price("US$ 19.99") == (1999, "USD")
+    assert parse_price("S$ 19.99") == (1999, "SGD")
+    assert parse_price("CDN$ 79.99") == (7999, "CAD")
+
+def test_parse_price_falls_back_to_region_for_bare_dollars():
+    assert parse_price("$19.99", "en-au") == (1999, "AUD")
+    assert parse_price("$19.99") == (1999, "USD")
+
+def test_parse_price_handles_separators_and_iso_codes():
+    assert parse_price("1.299,00 €") == (129900, "EUR")
+    assert parse_price("R 1 299") == (129900, "ZAR")
+    assert parse_price("19.99 CHF") == (1999, "CHF")
+    assert parse_price("N/A") == (None, None)
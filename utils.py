@@ -1,18 +1,17 @@
-import os, logging, time
-from bs4 import BeautifulSoup
-from pymongo import MongoClient
+from __future__ import annotations
+from typing import TYPE_CHECKING
+import os, re, logging, time, threading, json, hashlib, queue
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from logging.handlers import WatchedFileHandler
+from pymongo import MongoClient, monitoring
+from pymongo.errors import CollectionInvalid
 import requests
-from requests.adapters import HTTPAdapter
 from dotenv import load_dotenv
-from selenium import webdriver
-from selenium.webdriver.chrome.service import Service
-from selenium.webdriver.common.by import By
-from selenium.webdriver.chrome.options import Options
-from selenium.webdriver.support.ui import WebDriverWait
-from selenium.common.exceptions import TimeoutException
-from selenium.webdriver.support import expected_conditions as EC
-from selenium.webdriver.common.keys import Keys
-from webdriver_manager.chrome import ChromeDriverManager
+from metrics import MongoCommandTimer, instrument_session, inc_counter
+
+if TYPE_CHECKING:
+    from selenium import webdriver
 
 load_dotenv()
 
@@ -125,40 +124,560 @@ regions_nintendo = [
 ]
 
 # Database configuration
+# Total number of server connections all scraper processes may open together.
+# Each process gets an equal share of the budget as its pool size.
+MONGO_CONNECTION_BUDGET = int(os.getenv("MONGO_CONNECTION_BUDGET", "400"))
+
+_mongo_client = None
+_mongo_client_pid = None
+_mongo_client_lock = threading.Lock()
+
+class _PoolStatsListener(monitoring.ConnectionPoolListener):
+    """Keeps per-process connection pool counters for get_mongo_pool_stats()."""
+
+    def __init__(self):
+        self.stats = {
+            "open": 0,
+            "checked_out": 0,
+            "checked_out_peak": 0,
+            "created": 0,
+            "closed": 0,
+            "checkouts": 0,
+            "checkout_failures": 0,
+            "pool_cleared": 0,
+        }
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        self.stats["pool_cleared"] += 1
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self.stats["created"] += 1
+        self.stats["open"] += 1
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self.stats["closed"] += 1
+        self.stats["open"] -= 1
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self.stats["checkout_failures"] += 1
+
+    def connection_checked_out(self, event):
+        self.stats["checkouts"] += 1
+        self.stats["checked_out"] += 1
+        self.stats["checked_out_peak"] = max(self.stats["checked_out_peak"], self.stats["checked_out"])
+
+    def connection_checked_in(self, event):
+        self.stats["checked_out"] -= 1
+
+_pool_listener = None
+
+def configure_mongo_pool(n_workers):
+    """Declare how many processes will share MONGO_CONNECTION_BUDGET.
+
+    Count the parent too when it keeps a client of its own. Must be called
+    before the parent first connects; the value is passed to the children
+    through the environment.
+    """
+    os.environ["MONGO_POOL_WORKERS"] = str(max(1, int(n_workers)))
+
+def get_mongo_pool_size():
+    workers = max(1, int(os.getenv("MONGO_POOL_WORKERS", "1")))
+    return max(1, MONGO_CONNECTION_BUDGET // workers)
+
+def _reset_mongo_client():
+    # A client inherited through fork() shares sockets with the parent and
+    # must never be used by the child; drop it so the next call reconnects.
+    global _mongo_client, _mongo_client_pid, _pool_listener, _mongo_client_lock
+    _mongo_client = None
+    _mongo_client_pid = None
+    _pool_listener = None
+    _mongo_client_lock = threading.Lock()
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_mongo_client)
+
+def get_mongo_client():
+    """Return the process-wide MongoClient, creating it on first use."""
+    global _mongo_client, _mongo_client_pid, _pool_listener
+    pid = os.getpid()
+    if _mongo_client is not None and _mongo_client_pid == pid:
+        return _mongo_client
+    with _mongo_client_lock:
+        if _mongo_client is None or _mongo_client_pid != pid:
+            mongo_uri = os.getenv("MONGO_URI")
+            if not mongo_uri:
+                raise RuntimeError("MONGO_URI is not set")
+            _pool_listener = _PoolStatsListener()
+            _mongo_client = MongoClient(
+                mongo_uri,
+                maxPoolSize=get_mongo_pool_size(),
+                maxIdleTimeMS=60000,
+                event_listeners=[_pool_listener, MongoCommandTimer()],
+            )
+            _mongo_client_pid = pid
+    return _mongo_client
+
+def get_mongo_pool_stats():
+    """Connection pool usage of the current process."""
+    stats = dict(_pool_listener.stats) if _pool_listener else {}
+    stats["pid"] = os.getpid()
+    stats["max_pool_size"] = get_mongo_pool_size()
+    stats["connection_budget"] = MONGO_CONNECTION_BUDGET
+    return stats
+
+def log_mongo_pool_stats():
+    """Log how much of its pool the process used, to size MONGO_CONNECTION_BUDGET."""
+    stats = get_mongo_pool_stats()
+    log_info(
+        f"Mongo pool of pid {stats['pid']}: peak {stats.get('checked_out_peak', 0)}/{stats['max_pool_size']} "
+        f"connections in use, {stats.get('open', 0)} open, {stats.get('checkouts', 0)} checkouts, "
+        f"{stats.get('checkout_failures', 0)} failed checkouts, {stats.get('pool_cleared', 0)} pool clears"
+    )
+
 def get_mongo_db():
-    mongo_uri = os.getenv("MONGO_URI")
-    if not mongo_uri:
-        raise RuntimeError("MONGO_URI is not set")
-    client = MongoClient(mongo_uri)
+    client = get_mongo_client()
     try:
         db = client.get_default_database()
     except:
         db = client["test"]
     return db
 
-def update_mongo(db, collection_name):
-    """Atomically rename tmp → main collection without dropping first."""
+# Fields that describe how a document was fetched or served rather than the
+# game itself; they must not change the content hash.
+HASH_IGNORED_FIELDS = {
+    "_id", "content_hash", "unchanged", "service", "region", "fetched_at", "updated_at"
+}
+
+_indexed_collections = set()
+
+# price_values keys per service: the country part of each store region
+PRICE_REGIONS = {
+    "steam": sorted({region.split("-")[-1] for region in regions_steam}),
+    "xbox": sorted({"us"} | {region.split("-")[-1] for region in regions_xbox}),
+    "playstation": ["us"],
+    "nintendo": sorted({region.split("-")[-1] for region in regions_nintendo}),
+}
+
+def compute_content_hash(data):
+    """Stable hash of a game document, independent of key order."""
+    payload = {k: v for k, v in data.items() if k not in HASH_IGNORED_FIELDS}
+    encoded = json.dumps(payload, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha1(encoded.encode("utf-8")).hexdigest()
+
+def load_content_hashes(db, collection_name):
+    """Load title -> content_hash for the live snapshot in a single pass."""
+    hashes = {}
+    cursor = db[collection_name].find(
+        {"content_hash": {"$exists": True}},
+        {"_id": 0, "title": 1, "content_hash": 1}
+    ).batch_size(10000)
+    for doc in cursor:
+        hashes[doc["title"]] = doc["content_hash"]
+    return hashes
+
+def ensure_game_indexes(collection, details=False):
+    """Indexes every <service>_games collection needs.
+
+    The unique title index keeps upserts by title from scanning the
+    collection and native_id serves lookups by store id. Each store region
+    gets a partial (amount, title) index that serves both the price filters
+    and the price sorts in /games, so keyset pages never sort in memory.
+    Details collections only need the title.
+    """
+    key = (collection.database.name, collection.name)
+    if key in _indexed_collections:
+        return
+    collection.create_index("title", unique=True)
+    if not details:
+        collection.create_index("native_id")
+        collection.create_index("updated_at")
+        for region in PRICE_REGIONS.get(collection.name.split("_")[0], []):
+            amount_field = f"price_values.{region}.amount_minor"
+            collection.create_index(
+                [(amount_field, 1), ("title", 1)],
+                partialFilterExpression={amount_field: {"$exists": True}}
+            )
+    _indexed_collections.add(key)
+
+# Large fields that list views never show. They are kept in
+# <service>_game_details, keyed by title like the main collection.
+HEAVY_FIELDS = ("full_description", "screenshots")
+
+def details_collection_name(collection_name):
+    return collection_name.replace("_games", "_game_details")
+
+def split_game_document(data):
+    """Split a game into its list-view fields and its heavy detail fields."""
+    lean = {k: v for k, v in data.items() if k not in HEAVY_FIELDS}
+    details = {k: data[k] for k in HEAVY_FIELDS if k in data}
+    if details:
+        details["title"] = data.get("title")
+        details["native_id"] = data.get("native_id")
+    return lean, details
+
+def _rename_snapshot(db, name):
     db.client.admin.command(
         "renameCollection",
-        f"{db.name}.{collection_name}_tmp",
-        to=f"{db.name}.{collection_name}",
+        f"{db.name}.{name}_tmp",
+        to=f"{db.name}.{name}",
         dropTarget=True
     )
 
-def save_to_mongo(db, collection_name, data):
+def _merge_snapshot(db, name, listed, details=False):
+    tmp_coll = db[f"{name}_tmp"]
+    live_coll = db[name]
+    ensure_game_indexes(live_coll, details)
+    tmp_coll.aggregate([
+        {"$match": {"unchanged": {"$ne": True}}},
+        {"$project": {"_id": 0}},
+        {"$merge": {
+            "into": name,
+            "on": "title",
+            "whenMatched": "replace",
+            "whenNotMatched": "insert"
+        }}
+    ])
+    if not details:
+        # Unchanged games were still re-fetched by this run; skipped ones were not
+        tmp_coll.aggregate([
+            {"$match": {"unchanged": True, "skipped": {"$ne": True}}},
+            {"$project": {"_id": 0, "title": 1, "fetched_at": 1}},
+            {"$merge": {
+                "into": name,
+                "on": "title",
+                "whenMatched": [{"$set": {"fetched_at": "$$new.fetched_at"}}],
+                "whenNotMatched": "discard"
+            }}
+        ])
+
+    delisted = [
+        doc["title"] for doc in live_coll.find({}, {"_id": 0, "title": 1})
+        if doc.get("title") not in listed
+    ]
+    for i in range(0, len(delisted), 1000):
+        live_coll.delete_many({"title": {"$in": delisted[i:i + 1000]}})
+    tmp_coll.drop()
+
+# Per-service snapshot generation, bumped whenever the served data changes.
+# API workers key their response caches on it.
+GENERATIONS_COLLECTION = "snapshot_generations"
+
+def bump_generation(db, collection_name):
+    service = collection_name.replace("_games", "")
+    db[GENERATIONS_COLLECTION].update_one(
+        {"_id": service},
+        {"$inc": {"generation": 1}, "$set": {"updated_at": datetime.now(timezone.utc)}},
+        upsert=True
+    )
+
+# Per-service game counts, recomputed once per swapped snapshot for /games/count
+STATS_COLLECTION = "game_stats"
+
+def compute_game_stats(db, collection_name):
+    """Store the game count and the per-region count of priced games."""
+    coll = db[collection_name]
+    regions = {}
+    for row in coll.aggregate([
+        {"$project": {"prices": {"$objectToArray": {"$ifNull": ["$price_values", {}]}}}},
+        {"$unwind": "$prices"},
+        {"$match": {"prices.v.status": {"$in": ["ok", "free"]}}},
+        {"$group": {"_id": "$prices.k", "count": {"$sum": 1}}}
+    ]):
+        regions[row["_id"]] = row["count"]
+
+    db[STATS_COLLECTION].replace_one(
+        {"_id": collection_name.replace("_games", "")},
+        {
+            "count": coll.count_documents({}),
+            "regions": regions,
+            "computed_at": datetime.now(timezone.utc)
+        },
+        upsert=True
+    )
+
+def update_mongo(db, collection_name):
+    """Swap the finished tmp snapshot in as the live collection.
+
+    A full snapshot is renamed over the live collection atomically. When the
+    run skipped games whose content hash did not change, or that the refresh
+    plan left for a later run (see priority.plan_refresh), only the changed
+    documents are merged into the live collection and games that are no
+    longer listed are removed, so writes follow the real churn. A partial
+    plan is never renamed over the live collection, even without markers.
+    The details collection is swapped the same way.
+    """
+    from priority import plan_is_partial
+    details_name = details_collection_name(collection_name)
+    tmp_coll = db[f"{collection_name}_tmp"]
+    existing = db.list_collection_names()
+    if collection_name not in existing or (
+            not plan_is_partial(db, collection_name) and
+            tmp_coll.find_one({"unchanged": True}, {"_id": 1}) is None):
+        _rename_snapshot(db, collection_name)
+        if f"{details_name}_tmp" in existing:
+            _rename_snapshot(db, details_name)
+    else:
+        listed = {doc["title"] for doc in tmp_coll.find({}, {"_id": 0, "title": 1})}
+        _merge_snapshot(db, details_name, listed, details=True)
+        _merge_snapshot(db, collection_name, listed)
+    try:
+        compute_game_stats(db, collection_name)
+    except Exception as e:
+        log_info(f"Computing stats for {collection_name} failed: {e}")
+    bump_generation(db, collection_name)
+    if os.getenv("LINK_AFTER_SWAP", "1") == "1":
+        try:
+            from linker import link_games
+            link_games(db)
+        except Exception as e:
+            log_info(f"Linking games after {collection_name} swap failed: {e}")
+
+def save_to_mongo(db, collection_name, data, known_hashes=None):
+    """Upsert a game into the tmp snapshot.
+
+    known_hashes is the title -> content_hash map of the live snapshot (see
+    load_content_hashes). Games whose hash is unchanged are only marked as
+    still listed instead of being written out in full. Heavy fields go to
+    the details snapshot (see split_game_document).
+    """
     tmp_coll = db[f"{collection_name}_tmp"]
     title = data.get("title")
     if not title:
         return
+    ensure_game_indexes(tmp_coll)
+    if isinstance(data.get("prices"), dict):
+        data["price_values"] = normalize_prices(data["prices"])
+    data["fetched_at"] = datetime.now(timezone.utc)
+    content_hash = compute_content_hash(data)
+    data["content_hash"] = content_hash
+
+    service = collection_name.split("_")[0]
+    if known_hashes is not None and known_hashes.get(title) == content_hash:
+        inc_counter("scraper_games_total", {"service": service, "result": "unchanged"})
+        tmp_coll.update_one(
+            {"title": title},
+            {"$set": {
+                "title": title,
+                "content_hash": content_hash,
+                "fetched_at": data["fetched_at"],
+                "unchanged": True
+            }, "$unset": {"skipped": ""}},
+            upsert=True
+        )
+        return
+
+    inc_counter("scraper_games_total", {"service": service, "result": "changed"})
+    record_price_changes(db, collection_name, data)
+    data["updated_at"] = data["fetched_at"]
+
+    lean, details = split_game_document(data)
+    if details:
+        details_tmp = db[f"{details_collection_name(collection_name)}_tmp"]
+        ensure_game_indexes(details_tmp, details=True)
+        details_tmp.update_one({"title": title}, {"$set": details}, upsert=True)
+
     # Upsert by title in tmp collection
     tmp_coll.update_one(
         {"title": title},
-        {"$set": data},
+        {"$set": lean, "$unset": {"unchanged": "", "skipped": ""}},
         upsert=True
     )
 
+# Price history
+PRICE_HISTORY_COLLECTION = "price_history"
+
+# Currency symbols as they appear in the store price strings. "$" and "¥" are
+# ambiguous and resolved from the region in parse_price(). Longer symbols come
+# first so "US$" is not read as "S$".
+CURRENCY_SYMBOLS = [
+    ("US$", "USD"), ("CDN$", "CAD"), ("ARS$", "ARS"), ("Mex$", "MXN"), ("NZ$", "NZD"),
+    ("HK$", "HKD"), ("A$", "AUD"), ("C$", "CAD"), ("S$", "SGD"), ("R$", "BRL"),
+    ("€", "EUR"), ("£", "GBP"), ("₽", "RUB"), ("₹", "INR"), ("₩", "KRW"),
+    ("₺", "TRY"), ("₱", "PHP"), ("฿", "THB"), ("₸", "KZT"), ("zł", "PLN"),
+    ("Kč", "CZK"), ("Ft", "HUF"), ("lei", "RON"), ("RM", "MYR"), ("Rp", "IDR"),
+    ("SR", "SAR"), ("TL", "TRY"), ("kr", "NOK"), ("R", "ZAR"),
+]
+
+ISO_CURRENCIES = {
+    "USD", "EUR", "GBP", "JPY", "CNY", "INR", "BRL", "AUD", "CAD", "RUB", "KRW",
+    "MXN", "ZAR", "ARS", "TRY", "IDR", "SGD", "PHP", "THB", "MYR", "NZD", "SAR",
+    "AED", "HUF", "COP", "PLN", "NOK", "CLP", "PEN", "CHF", "HKD", "BHD", "QAR",
+    "KWD", "OMR", "RON", "CZK", "SEK", "DKK", "KZT", "UAH",
+}
+
+REGION_DOLLARS = {
+    "us": "USD", "ca": "CAD", "au": "AUD", "nz": "NZD", "mx": "MXN", "ar": "ARS",
+    "cl": "CLP", "co": "COP", "sg": "SGD", "hk": "HKD",
+}
+
+def _parse_amount(number):
+    """Turn '1 299', '1.299,00' or '19.99' into hundredths of the unit."""
+    number = number.replace(" ", "").replace("\u00a0", "").replace("\u202f", "").replace("'", "")
+    if "," in number and "." in number:
+        decimal = "," if number.rfind(",") > number.rfind(".") else "."
+    elif number.count(",") == 1 and len(number.split(",")[1]) != 3:
+        decimal = ","
+    elif number.count(".") == 1 and len(number.split(".")[1]) != 3:
+        decimal = "."
+    else:
+        decimal = None
+    if decimal:
+        whole, _, fraction = number.rpartition(decimal)
+    else:
+        whole, fraction = number, ""
+    whole = whole.replace(",", "").replace(".", "")
+    fraction = (fraction + "00")[:2]
+    if not whole.isdigit() and whole:
+        return None
+    return int(whole or "0") * 100 + int(fraction)
+
+def parse_price(display, region=None):
+    """Parse a store price string into (amount_minor, currency).
+
+    amount_minor is the price in hundredths of the currency unit. Returns
+    (None, None) for strings that carry no price such as "N/A".
+    """
+    if not isinstance(display, str):
+        return None, None
+    match = re.search(r"\d[\d\s.,'\u00a0\u202f]*", display)
+    if not match:
+        return None, None
+    amount_minor = _parse_amount(match.group().strip(" .,"))
+    if amount_minor is None:
+        return None, None
+
+    rest = (display[:match.start()] + " " + display[match.end():]).strip()
+    for code in re.findall(r"\b[A-Z]{3}\b", rest):
+        if code in ISO_CURRENCIES:
+            return amount_minor, code
+    for symbol, currency in CURRENCY_SYMBOLS:
+        if symbol.isalpha():
+            found = re.search(rf"(?<![A-Za-z]){symbol}(?![A-Za-z])", rest)
+        else:
+            found = symbol in rest
+        if found:
+            return amount_minor, currency
+    region = (region or "").split("-")[-1].lower()
+    if "$" in rest:
+        return amount_minor, REGION_DOLLARS.get(region, "USD")
+    if "¥" in rest or "￥" in rest:
+        return amount_minor, "CNY" if region == "cn" else "JPY"
+    return amount_minor, None
+
+def normalize_price(display, region=None):
+    """Structured form of a store price string.
+
+    status is "ok" for a parsed price, "free" for free games and
+    "unavailable" for every store-specific sentinel ("N/A",
+    "Free or Not Available", "BUNDLE NOT AVAILABLE", ...).
+    """
+    amount_minor, currency = parse_price(display, region)
+    if amount_minor is not None:
+        return {"amount_minor": amount_minor, "currency": currency, "status": "ok"}
+    text = display.strip().lower() if isinstance(display, str) else ""
+    if text.startswith("free") and "not available" not in text:
+        return {"amount_minor": 0, "currency": None, "status": "free"}
+    return {"amount_minor": None, "currency": None, "status": "unavailable"}
+
+def normalize_prices(prices):
+    return {region: normalize_price(display, region) for region, display in prices.items()}
+
+_price_history_ready = set()
+
+def ensure_price_history_collection(db):
+    """Create the price history time-series collection and its index once."""
+    if db.name in _price_history_ready:
+        return db[PRICE_HISTORY_COLLECTION]
+    if PRICE_HISTORY_COLLECTION not in db.list_collection_names():
+        try:
+            db.create_collection(
+                PRICE_HISTORY_COLLECTION,
+                timeseries={"timeField": "ts", "metaField": "meta", "granularity": "hours"}
+            )
+        except CollectionInvalid:
+            pass  # created by another worker in the meantime
+    coll = db[PRICE_HISTORY_COLLECTION]
+    coll.create_index([("meta.store", 1), ("meta.native_id", 1), ("meta.region", 1), ("ts", -1)])
+    _price_history_ready.add(db.name)
+    return coll
+
+def record_price_changes(db, collection_name, data):
+    """Append an observation for every region whose price differs from the live snapshot."""
+    prices = data.get("prices")
+    if not isinstance(prices, dict) or not prices:
+        return
+    previous = db[collection_name].find_one(
+        {"title": data.get("title")}, {"_id": 0, "prices": 1}
+    ) or {}
+    previous_prices = previous.get("prices") or {}
+
+    store = collection_name.replace("_games", "")
+    now = datetime.now(timezone.utc)
+    observations = []
+    for region, display in prices.items():
+        if previous_prices.get(region) == display:
+            continue
+        value = normalize_price(display, region)
+        observations.append({
+            "ts": now,
+            "meta": {
+                "store": store,
+                "native_id": data.get("native_id"),
+                "region": region,
+            },
+            "title": data.get("title"),
+            "price": display,
+            "amount_minor": value["amount_minor"],
+            "currency": value["currency"],
+            "status": value["status"],
+        })
+    if not observations:
+        return
+    try:
+        ensure_price_history_collection(db).insert_many(observations, ordered=False)
+    except Exception as e:
+        log_info(f"Price history insert failed for {data.get('title')}: {e}")
+
+# Selenium is imported on first use, only by processes that drive a browser
+_selenium_api = None
+
+def _selenium():
+    """The Selenium classes the browser helpers use, imported once."""
+    global _selenium_api
+    if _selenium_api is None:
+        from types import SimpleNamespace
+        from selenium import webdriver
+        from selenium.webdriver.chrome.service import Service
+        from selenium.webdriver.chrome.options import Options
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.common.keys import Keys
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.webdriver.support.ui import WebDriverWait
+        from selenium.common.exceptions import TimeoutException, WebDriverException
+        _selenium_api = SimpleNamespace(
+            webdriver=webdriver, Service=Service, Options=Options, By=By, Keys=Keys, EC=EC,
+            WebDriverWait=WebDriverWait, TimeoutException=TimeoutException, WebDriverException=WebDriverException
+        )
+    return _selenium_api
+
 def get_selenium_browser(retries=3):
-    options = Options()
+    sel = _selenium()
+    options = sel.Options()
     options.add_argument('--no-sandbox')  # Critical for Linux/Docker
     options.add_argument('--disable-dev-shm-usage')  # For limited shared memory
     options.add_argument('--headless')  # If running headless
@@ -174,11 +693,37 @@ def get_selenium_browser(retries=3):
     if not driver_path:
         from webdriver_manager.chrome import ChromeDriverManager
         driver_path = ChromeDriverManager().install()
-    service = Service(executable_path=driver_path)
-    driver = webdriver.Chrome(service=service, options=options)
+    service = sel.Service(executable_path=driver_path)
+    driver = sel.webdriver.Chrome(service=service, options=options)
     
     return driver
 
+# Proxies are read from proxies.txt on first use, once per process. The
+# scheduler gives each concurrent scraper its own slice ("start:end") through
+# SCRAPER_PROXY_SLICE.
+PROXY_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "proxies.txt")
+_proxies = None
+
+def get_proxies():
+    global _proxies
+    if _proxies is None:
+        try:
+            with open(PROXY_FILE, "r") as f:
+                _proxies = [line.strip() for line in f if line.strip()]
+        except OSError as e:
+            log_info(f"Could not read {PROXY_FILE}: {e}")
+            _proxies = []
+        proxy_slice = os.getenv("SCRAPER_PROXY_SLICE")
+        if proxy_slice:
+            start, _, end = proxy_slice.partition(":")
+            _proxies = _proxies[int(start or 0):int(end) if end else None]
+    return _proxies
+
+def split_proxies(n_chunks):
+    proxies = get_proxies()
+    chunk_size = (len(proxies) + n_chunks - 1) // n_chunks
+    return [proxies[i * chunk_size:(i + 1) * chunk_size] for i in range(n_chunks)]
+
 def create_session(proxy=None, timeout=(5,15)):
     import functools, requests
     from requests.adapters import HTTPAdapter
@@ -191,17 +736,18 @@ def create_session(proxy=None, timeout=(5,15)):
 
     if proxy:
         session.proxies = {"http": proxy, "https": proxy}
-    return session
+    return instrument_session(session)
 
 
 def click_loadmore_btn(browser, btn_dom):
+    sel = _selenium()
     count = 0
     while True:
         try:
-            btn = WebDriverWait(browser, 60).until(
-                EC.element_to_be_clickable((By.XPATH, btn_dom))
+            btn = sel.WebDriverWait(browser, 60).until(
+                sel.EC.element_to_be_clickable((sel.By.XPATH, btn_dom))
             )
-        except TimeoutException:
+        except sel.TimeoutException:
             print("Timeout: Load more button not found or not clickable.")
             return browser
         except Exception as e:
@@ -209,125 +755,408 @@ def click_loadmore_btn(browser, btn_dom):
             print("-"*10, "! load more : exception occur : plz check the network !", "-"*10)
             time.sleep(60)
             continue
-        btn = browser.find_element(By.XPATH, btn_dom)
+        btn = browser.find_element(sel.By.XPATH, btn_dom)
         btn.click()
         count += 1
         if(count % 50 == 0):
             print("-"*10, "Load more button", count, " times clikced in Xbox","-"*10)
 
 def search_game(browser, search_dom, result_dom, title):
+    from bs4 import BeautifulSoup
+    sel = _selenium()
     try:
-        locator = (By.CSS_SELECTOR, search_dom)
-        WebDriverWait(browser, 10).until(
-            EC.presence_of_all_elements_located(locator)  # Wait for matching element
+        locator = (sel.By.CSS_SELECTOR, search_dom)
+        sel.WebDriverWait(browser, 10).until(
+            sel.EC.presence_of_all_elements_located(locator)  # Wait for matching element
         )
         search_input = browser.find_elements(*locator)[-1]
 
-        WebDriverWait(browser, 10).until(EC.element_to_be_clickable(search_input))
+        sel.WebDriverWait(browser, 10).until(sel.EC.element_to_be_clickable(search_input))
         search_input.send_keys(title)
-        search_input.send_keys(Keys.RETURN)
+        search_input.send_keys(sel.Keys.RETURN)
 
-        locator = (By.CSS_SELECTOR, result_dom)
-        WebDriverWait(browser, 10).until(
-            EC.visibility_of_all_elements_located(locator)
+        locator = (sel.By.CSS_SELECTOR, result_dom)
+        sel.WebDriverWait(browser, 10).until(
+            sel.EC.visibility_of_all_elements_located(locator)
         )
         soup = BeautifulSoup(browser.page_source, 'html.parser')
         return soup
-    except TimeoutException:
+    except sel.TimeoutException:
         return []
     
 # Steam functions
+STEAM_STEP_TIMEOUT = int(os.getenv("STEAM_STEP_TIMEOUT", "15"))
+
+PAYMENT_BUTTON_XPATH = '//button[@class="qV80oahDZsbXiS6lIDLND DialogButton _DialogLayout Primary Focusable"]'
+# The profile's friend button area once a friend invite is pending
+INVITE_SENT_XPATH = '//*[contains(text(), "Invite Sent") or contains(text(), "Cancel Invite")]'
+
+class SteamStepError(Exception):
+    def __init__(self, step, timings, cause):
+        super().__init__(f"Step '{step}' failed: {cause}")
+        self.step = step
+        self.timings = timings
+
+@contextmanager
+def timed_step(timings: dict, name: str):
+    """Record how long a step of a browser flow took, in milliseconds."""
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        timings[name] = round((time.perf_counter() - started) * 1000)
+        raise SteamStepError(name, timings, e) from e
+    timings[name] = round((time.perf_counter() - started) * 1000)
+
+def wait_for(driver, condition, timeout=None):
+    sel = _selenium()
+    return sel.WebDriverWait(driver, timeout or STEAM_STEP_TIMEOUT, poll_frequency=0.1).until(condition)
+
+def document_ready(driver):
+    return driver.execute_script("return document.readyState") == "complete"
+
 def steam_purchase(title: str, friend: str):
-    driver = get_selenium_browser()
-    steam_store_login(driver)
-    driver.get(f'https://store.steampowered.com/search/?term={title}')
-    results = driver.find_elements(By.CLASS_NAME, 'search_result_row')
-
-    item_link = results[0].get_attribute('href')
-    driver.get(item_link)
-
-    WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.LINK_TEXT, 'Add to Cart'))).click()
-    time.sleep(5)
-    driver.get('https://store.steampowered.com/cart')
-    WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, '//button[@class="_2GLDG_XIMaVS7hU2xEFzBo DialogDropDown _DialogInputContainer  Focusable"]'))).click()
-    dialog_menu_position = WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.CLASS_NAME, 'DialogMenuPosition')))
-    dialog_menu_position.find_elements(By.TAG_NAME, 'button')[-1].click()
-    payment_btns = WebDriverWait(driver, 10).until(EC.presence_of_all_elements_located((By.XPATH, '//button[@class="qV80oahDZsbXiS6lIDLND DialogButton _DialogLayout Primary Focusable"]')))
-    payment_btns[-1].click()
-
-    driver.find_element(By.XPATH, '//button[@class="DialogButton _DialogLayout Primary Focusable"]').click()
-    
-    WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.XPATH, '//input[@class="DialogInput DialogInputPlaceholder DialogTextInputBase _1OuNJQWR-7lSdtgyJf69uF Focusable"]'))).send_keys(friend)
-    
-    results = WebDriverWait(driver, 10).until(EC.presence_of_all_elements_located((By.XPATH, '//div[@class="_321Woxp4ONn3k90_NLayE0 _3td3cAnGbbbAOXW8x2pD-j _29WypCpglgRKsR_fMPsoFX Panel Focusable"]')))
-    results[0].click()
-        
-    payment_btns = WebDriverWait(driver, 10).until(EC.presence_of_all_elements_located((By.XPATH, '//button[@class="qV80oahDZsbXiS6lIDLND DialogButton _DialogLayout Primary Focusable"]')))
-    payment_btns[-1].click()
-    time.sleep(5)
-    WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.ID, 'accept_ssa'))).click()
-    driver.find_element(By.LINK_TEXT, 'Purchase').click()
-    time.sleep(3)
-    driver.quit()
+    """Buy `title` as a gift for `friend`; returns per-step timings in ms."""
+    timings = {}
+    started = time.perf_counter()
+    try:
+        with steam_session("store") as driver:
+            timings["session"] = round((time.perf_counter() - started) * 1000)
+            _steam_purchase(driver, title, friend, timings)
+    except SteamStepError as e:
+        log_info(f"Steam purchase of {title} failed at {e.step}: {timings}")
+        raise
+    except Exception as e:
+        log_info(f"Steam purchase of {title} failed before checkout: {e}")
+        raise
+    log_info(f"Steam purchase of {title} took {sum(timings.values())} ms: {timings}")
+    return timings
+
+def _steam_purchase(driver, title: str, friend: str, timings: dict):
+    sel = _selenium()
+    with timed_step(timings, "search"):
+        driver.get(f'https://store.steampowered.com/search/?term={title}')
+        results = wait_for(driver, sel.EC.presence_of_all_elements_located((sel.By.CLASS_NAME, 'search_result_row')))
+        item_link = results[0].get_attribute('href')
+
+    with timed_step(timings, "open_app_page"):
+        driver.get(item_link)
+        add_to_cart = wait_for(driver, sel.EC.element_to_be_clickable((sel.By.LINK_TEXT, 'Add to Cart')))
+
+    with timed_step(timings, "add_to_cart"):
+        add_to_cart.click()
+        # Done once the store has reacted: cart page, "In Cart" button or the old button replaced
+        wait_for(driver, sel.EC.any_of(
+            sel.EC.url_contains('/cart'),
+            sel.EC.presence_of_element_located((sel.By.PARTIAL_LINK_TEXT, 'In Cart')),
+            sel.EC.staleness_of(add_to_cart)
+        ))
+
+    with timed_step(timings, "open_cart"):
+        driver.get('https://store.steampowered.com/cart')
+        wait_for(driver, document_ready)
+        wait_for(driver, sel.EC.element_to_be_clickable((sel.By.XPATH, '//button[@class="_2GLDG_XIMaVS7hU2xEFzBo DialogDropDown _DialogInputContainer  Focusable"]'))).click()
+
+    with timed_step(timings, "choose_gift"):
+        dialog_menu_position = wait_for(driver, sel.EC.presence_of_element_located((sel.By.CLASS_NAME, 'DialogMenuPosition')))
+        dialog_menu_position.find_elements(sel.By.TAG_NAME, 'button')[-1].click()
+        payment_btns = wait_for(driver, sel.EC.presence_of_all_elements_located((sel.By.XPATH, PAYMENT_BUTTON_XPATH)))
+        payment_btns[-1].click()
+        wait_for(driver, sel.EC.element_to_be_clickable((sel.By.XPATH, '//button[@class="DialogButton _DialogLayout Primary Focusable"]'))).click()
+
+    with timed_step(timings, "select_friend"):
+        wait_for(driver, sel.EC.presence_of_element_located((sel.By.XPATH, '//input[@class="DialogInput DialogInputPlaceholder DialogTextInputBase _1OuNJQWR-7lSdtgyJf69uF Focusable"]'))).send_keys(friend)
+        results = wait_for(driver, sel.EC.presence_of_all_elements_located((sel.By.XPATH, '//div[@class="_321Woxp4ONn3k90_NLayE0 _3td3cAnGbbbAOXW8x2pD-j _29WypCpglgRKsR_fMPsoFX Panel Focusable"]')))
+        results[0].click()
+        payment_btns = wait_for(driver, sel.EC.presence_of_all_elements_located((sel.By.XPATH, PAYMENT_BUTTON_XPATH)))
+        payment_btns[-1].click()
+
+    with timed_step(timings, "checkout_page"):
+        wait_for(driver, sel.EC.element_to_be_clickable((sel.By.ID, 'accept_ssa'))).click()
+        purchase_btn = wait_for(driver, sel.EC.element_to_be_clickable((sel.By.LINK_TEXT, 'Purchase')))
+
+    with timed_step(timings, "confirm_purchase"):
+        checkout_url = driver.current_url
+        purchase_btn.click()
+        # The checkout page moves on to the receipt once the transaction is accepted
+        wait_for(driver, sel.EC.any_of(sel.EC.url_changes(checkout_url), sel.EC.invisibility_of_element(purchase_btn)))
 
 def steam_send_invite(profile_link: str):
-    driver = get_selenium_browser()
-    steam_commnunity_login(driver)
-    driver.get(profile_link)
-    WebDriverWait(driver, 10).until(EC.presence_of_element_located((By.LINK_TEXT, 'Add Friend'))).click()
-    time.sleep(3)
-    driver.quit()
+    sel = _selenium()
+    with steam_session("community") as driver:
+        driver.get(profile_link)
+        add_friend = sel.WebDriverWait(driver, 10).until(sel.EC.element_to_be_clickable((sel.By.LINK_TEXT, 'Add Friend')))
+        add_friend.click()
+        wait_for(driver, sel.EC.presence_of_element_located((sel.By.XPATH, INVITE_SENT_XPATH)))
+    invalidate_steam_friends()
 
 def steam_is_friend(profile_link: str):
+    steam_id = resolve_steam_id(profile_link)
+    if steam_id:
+        try:
+            return steam_id in steam_friend_ids()
+        except Exception as e:
+            log_info(f"Steam friend list unavailable, checking profile page: {e}")
+    return steam_is_friend_browser(profile_link)
+
+def steam_is_friend_browser(profile_link: str):
+    sel = _selenium()
     try:
-        driver = get_selenium_browser()
-        steam_commnunity_login(driver)
-        driver.get(profile_link)
+        with steam_session("community") as driver:
+            driver.get(profile_link)
+            try:
+                sel.WebDriverWait(driver, 3).until(sel.EC.presence_of_element_located((sel.By.LINK_TEXT, 'Message')))
+                return True
+            except sel.TimeoutException:
+                return False
     except Exception as e:
         print(f"Error getting profile: {e}")
-    
+        return False
+
+# Persistent Steam browser sessions: a few long-lived Chrome instances that
+# stay logged in. Cookies are saved to disk so new browsers start logged in,
+# and the login form is only used when the session cookie has expired.
+STEAM_SESSION_POOL_SIZE = int(os.getenv("STEAM_SESSION_POOL_SIZE", "2"))
+STEAM_COOKIE_FILE = os.getenv(
+    "steam_cookie_file",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "steam_cookies.json")
+)
+STEAM_SITES = {
+    "store": "store.steampowered.com",
+    "community": "steamcommunity.com",
+}
+
+_steam_sessions = queue.Queue()
+_steam_sessions_created = 0
+_steam_sessions_lock = threading.Lock()
+_steam_cookie_lock = threading.Lock()
+
+def load_steam_cookies():
+    try:
+        with open(STEAM_COOKIE_FILE, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return []
+
+def save_steam_cookies(driver):
+    cookies = driver.execute_cdp_cmd("Network.getAllCookies", {}).get("cookies", [])
+    cookies = [c for c in cookies if "steam" in c.get("domain", "")]
+    with _steam_cookie_lock:
+        tmp_path = f"{STEAM_COOKIE_FILE}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(cookies, f)
+        os.replace(tmp_path, STEAM_COOKIE_FILE)
+
+def steam_logged_in(driver, site):
+    """Cheap login check: a non-expired steamLoginSecure cookie for the site, no page load."""
+    domain = STEAM_SITES[site]
+    now = time.time()
+    for cookie in driver.execute_cdp_cmd("Network.getAllCookies", {}).get("cookies", []):
+        if cookie.get("name") != "steamLoginSecure" or not cookie.get("domain", "").lstrip(".").endswith(domain):
+            continue
+        expires = cookie.get("expires", -1)
+        if expires in (-1, 0) or expires > now + 60:
+            return True
+    return False
+
+def new_steam_browser():
+    driver = get_selenium_browser()
+    cookies = load_steam_cookies()
+    if cookies:
+        params = [
+            {k: v for k, v in c.items() if k in ("name", "value", "domain", "path", "secure", "httpOnly", "sameSite", "expires")}
+            for c in cookies
+        ]
+        driver.execute_cdp_cmd("Network.enable", {})
+        driver.execute_cdp_cmd("Network.setCookies", {"cookies": params})
+    return driver
+
+def _browser_alive(driver):
     try:
-        WebDriverWait(driver, 3).until(EC.presence_of_element_located((By.LINK_TEXT, 'Message')))
-        driver.quit()
+        driver.current_url
         return True
-    except:
+    except Exception:
         return False
 
-def steam_store_login(driver: webdriver.Chrome):
+@contextmanager
+def steam_session(site="store"):
+    """Borrow a logged-in browser from the pool; logs in only if the session expired."""
+    global _steam_sessions_created
+    sel = _selenium()
+    driver = None
+    try:
+        driver = _steam_sessions.get_nowait()
+    except queue.Empty:
+        with _steam_sessions_lock:
+            create = _steam_sessions_created < STEAM_SESSION_POOL_SIZE
+            if create:
+                _steam_sessions_created += 1
+        if create:
+            try:
+                driver = new_steam_browser()
+            except Exception:
+                with _steam_sessions_lock:
+                    _steam_sessions_created -= 1
+                raise
+        else:
+            driver = _steam_sessions.get()
+
+    healthy = True
+    try:
+        if not _browser_alive(driver):
+            try:
+                driver.quit()
+            except Exception:
+                pass
+            driver = new_steam_browser()
+        if not steam_logged_in(driver, site):
+            if site == "store":
+                steam_store_login(driver)
+            else:
+                steam_commnunity_login(driver)
+            if steam_logged_in(driver, site):
+                save_steam_cookies(driver)
+        yield driver
+    except (sel.WebDriverException, SteamStepError):
+        # A flow that failed half-way leaves the browser on an unknown page
+        healthy = False
+        raise
+    finally:
+        if healthy and _browser_alive(driver):
+            _steam_sessions.put(driver)
+        else:
+            try:
+                driver.quit()
+            except Exception:
+                pass
+            with _steam_sessions_lock:
+                _steam_sessions_created -= 1
+
+# Cached friend list of the bot account, fetched over HTTP with the saved
+# session cookies so friend checks don't need a browser.
+STEAM_FRIENDS_TTL = int(os.getenv("STEAM_FRIENDS_TTL", "60"))
+STEAM_HTTP_TIMEOUT = (5, 15)
+
+_steam_friends = {"ids": None, "fetched_at": 0.0}
+_steam_friends_lock = threading.Lock()
+_steam_vanity_ids = {}
+
+def steam_http_session():
+    session = requests.Session()
+    for cookie in load_steam_cookies():
+        session.cookies.set(cookie["name"], cookie["value"], domain=cookie.get("domain"), path=cookie.get("path", "/"))
+    return session
+
+def steam_account_id():
+    """steamid64 of the bot account, taken from the steamLoginSecure cookie."""
+    for cookie in load_steam_cookies():
+        if cookie.get("name") == "steamLoginSecure" and "steamcommunity.com" in cookie.get("domain", ""):
+            match = re.match(r"(\d{17})", requests.utils.unquote(cookie.get("value", "")))
+            if match:
+                return match.group(1)
+    return None
+
+def resolve_steam_id(profile_link: str, session=None):
+    """steamid64 for a /profiles/<id> or /id/<vanity> link, None if unresolvable."""
+    match = re.search(r"steamcommunity\.com/profiles/(\d{17})", profile_link or "")
+    if match:
+        return match.group(1)
+    match = re.search(r"steamcommunity\.com/id/([^/?#]+)", profile_link or "")
+    if not match:
+        return None
+    vanity = match.group(1).lower()
+    if vanity in _steam_vanity_ids:
+        return _steam_vanity_ids[vanity]
+    try:
+        session = session or requests.Session()
+        response = session.get(f"https://steamcommunity.com/id/{vanity}/?xml=1", timeout=STEAM_HTTP_TIMEOUT)
+        found = re.search(r"<steamID64>(\d{17})</steamID64>", response.text)
+    except requests.RequestException as e:
+        log_info(f"Failed to resolve Steam profile {profile_link}: {e}")
+        return None
+    if not found:
+        return None
+    _steam_vanity_ids[vanity] = found.group(1)
+    return found.group(1)
+
+def fetch_steam_friends():
+    account_id = steam_account_id()
+    if not account_id:
+        raise LookupError("No saved Steam community session")
+    response = steam_http_session().get(
+        f"https://steamcommunity.com/profiles/{account_id}/friends/",
+        timeout=STEAM_HTTP_TIMEOUT
+    )
+    response.raise_for_status()
+    if "/login" in response.url or 'id="friends_list"' not in response.text:
+        raise LookupError("Steam community session expired")
+    return set(re.findall(r'data-steamid="(\d{17})"', response.text)) - {account_id}
+
+def steam_friend_ids(force=False):
+    """Friend steamids of the bot account, refreshed every STEAM_FRIENDS_TTL seconds."""
+    with _steam_friends_lock:
+        fresh = time.monotonic() - _steam_friends["fetched_at"] < STEAM_FRIENDS_TTL
+        if _steam_friends["ids"] is not None and fresh and not force:
+            return _steam_friends["ids"]
+        try:
+            ids = fetch_steam_friends()
+        except LookupError:
+            # Log in once through the browser pool to refresh the saved cookies
+            with steam_session("community"):
+                pass
+            ids = fetch_steam_friends()
+        _steam_friends["ids"] = ids
+        _steam_friends["fetched_at"] = time.monotonic()
+        return ids
+
+def invalidate_steam_friends():
+    with _steam_friends_lock:
+        _steam_friends["fetched_at"] = 0.0
+
+def steam_store_login(driver: "webdriver.Chrome"):
+    sel = _selenium()
     try:
         st_username = os.getenv("steam_username")
         st_password = os.getenv("steam_password")
         
         driver.get('https://store.steampowered.com/login')
-        inputs = WebDriverWait(driver, 10).until(EC.presence_of_all_elements_located((By.CLASS_NAME, '_2GBWeup5cttgbTw8FM3tfx')))
+        inputs = sel.WebDriverWait(driver, 10).until(sel.EC.presence_of_all_elements_located((sel.By.CLASS_NAME, '_2GBWeup5cttgbTw8FM3tfx')))
         inputs[0].send_keys(st_username)
         inputs[1].send_keys(st_password)
-        driver.find_element(By.CLASS_NAME, 'DjSvCZoKKfoNSmarsEcTS').click()
-        time.sleep(5)
+        driver.find_element(sel.By.CLASS_NAME, 'DjSvCZoKKfoNSmarsEcTS').click()
+        # Logged in as soon as Steam sets the session cookie
+        wait_for(driver, lambda d: steam_logged_in(d, "store"))
     except Exception as e:
         print(f"Error logging in: {e}")
         
-def steam_commnunity_login(driver: webdriver.Chrome):
+def steam_commnunity_login(driver: "webdriver.Chrome"):
+    sel = _selenium()
     try:
         st_username = os.getenv("steam_username")
         st_password = os.getenv("steam_password")
         
         driver.get('https://steamcommunity.com/login/home/?goto=')
-        inputs = WebDriverWait(driver, 10).until(EC.presence_of_all_elements_located((By.CLASS_NAME, '_2GBWeup5cttgbTw8FM3tfx')))
+        inputs = sel.WebDriverWait(driver, 10).until(sel.EC.presence_of_all_elements_located((sel.By.CLASS_NAME, '_2GBWeup5cttgbTw8FM3tfx')))
         inputs[0].send_keys(st_username)
         inputs[1].send_keys(st_password)
-        driver.find_element(By.CLASS_NAME, 'DjSvCZoKKfoNSmarsEcTS').click()
-        time.sleep(5)
+        driver.find_element(sel.By.CLASS_NAME, 'DjSvCZoKKfoNSmarsEcTS').click()
+        # Logged in as soon as Steam sets the session cookie
+        wait_for(driver, lambda d: steam_logged_in(d, "community"))
     except Exception as e:
         print(f"Error logging in: {e}")
 
 # Configure logging
+# The API workers, the scheduler and every scraper process append to the
+# same file, so none of them rotates it: logrotate moves it aside (see
+# scraper.logrotate) and each process reopens it on its next write.
+LOG_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "scraper.log")
+
 for handler in logging.root.handlers[:]:
     logging.root.removeHandler(handler)
+log_handler = WatchedFileHandler(LOG_PATH)
+log_handler.setFormatter(logging.Formatter("%(asctime)s - %(levelname)s - %(message)s"))
 logging.basicConfig(
-    filename="scraper.log",
-    filemode="a",
-    format="%(asctime)s - %(levelname)s - %(message)s",
+    handlers=[log_handler],
     level=logging.INFO,
 )
 # Remove unwanted logs from third-party libraries